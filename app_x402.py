@@ -1,23 +1,102 @@
 # app_x402.py
+import asyncio
 import base64
 import json
 import ast
+import os
+import secrets
+import signal
+from contextlib import asynccontextmanager
 from decimal import Decimal
 
-from fastapi import FastAPI, Request, Header, HTTPException
+from fastapi import FastAPI, Request, Header, HTTPException, Query
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import JSONResponse
 from pydantic import BaseModel
 
-from chain_utils import get_web3, get_relayer_account, get_token_address
-from erc20_utils import human_to_token_amount
-from sign.eip3009_meta import relay_two_auth, human_to_atomic, relayer_account
+from sign.eip3009_meta import relayer_account
+from sign.eip3009_preflight import preflight_two_auth, invalidate_balance, PreflightError
+from settlement_router import router, SettlementHandedOff
+from transfer_indexer import TransferStore, TransferIndexer
+
+# ==== Transfer 事件索引（/history 用） ====
+INDEXER_ENABLED = os.getenv("INDEXER_ENABLED", "true").lower() in ("1", "true", "yes")
+# 关掉索引时不建库（也不会在工作目录里留下 transfers.db）
+transfer_store = TransferStore() if INDEXER_ENABLED else None
+transfer_indexer = TransferIndexer(transfer_store) if INDEXER_ENABLED else None
+
+# ==== 排空（滚动发布 / 缩容） ====
+# 收到 SIGTERM 或 POST /admin/drain 后：新的付费请求回 503 + Retry-After，402 报价照常；
+# 在途结算最多再等 DRAIN_TIMEOUT_SECONDS 走完；到期后不再等回执，但没广播的那一笔照样广播，
+# 回执没确认的带着交易哈希记到 PENDING_SETTLEMENTS_FILE。
+DRAIN_TIMEOUT_SECONDS = float(os.getenv("DRAIN_TIMEOUT_SECONDS", "30"))
+DRAIN_RETRY_AFTER_SECONDS = int(os.getenv("DRAIN_RETRY_AFTER_SECONDS", "5"))
+DRAIN_ON_SIGTERM = os.getenv("DRAIN_ON_SIGTERM", "true").lower() in ("1", "true", "yes")
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")  # 为空时不开放 /admin/drain
+_drain_task: asyncio.Task | None = None
+_sigterm_received = False
+
+
+async def _drain_then_exit(signum, frame, previous):
+    await run_in_threadpool(router.drain, DRAIN_TIMEOUT_SECONDS)
+    # 排空完再交回给 uvicorn 原来的处理（开始正常退出）
+    signal.signal(signum, previous)
+    if callable(previous):
+        previous(signum, frame)
+    else:
+        signal.raise_signal(signum)
+
+
+def _install_sigterm_drain():
+    loop = asyncio.get_running_loop()
+    previous = signal.getsignal(signal.SIGTERM)
+
+    def start_drain(signum, frame):
+        global _drain_task
+        print(f"[x402] SIGTERM received, draining (up to {DRAIN_TIMEOUT_SECONDS}s)...")
+        router.begin_drain()
+        _drain_task = loop.create_task(_drain_then_exit(signum, frame, previous))
+
+    def on_sigterm(signum, frame):
+        global _sigterm_received
+        if _sigterm_received:
+            # 第二次 SIGTERM：不再等，直接按原来的方式退出
+            if callable(previous):
+                previous(signum, frame)
+            return
+        _sigterm_received = True
+        # 信号处理函数可能打断事件循环 / 持锁中的代码，这里不直接建 task、不拿锁，排到事件循环里去做
+        loop.call_soon_threadsafe(start_drain, signum, frame)
 
-app = FastAPI(title="x402 Relay Demo (Sepolia / USDC)")
+    try:
+        signal.signal(signal.SIGTERM, on_sigterm)
+    except ValueError:
+        # 不在主线程里（比如被嵌进别的进程跑），只能靠 /admin/drain
+        print("[x402] not in main thread, SIGTERM drain disabled")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # 各结算通道的 token 元数据启动时查好，报价时不再访问 RPC
+    await run_in_threadpool(router.warm_up)
+    if INDEXER_ENABLED:
+        await run_in_threadpool(transfer_indexer.watch, relayer_account.address)
+        transfer_indexer.start()
+    if DRAIN_ON_SIGTERM:
+        _install_sigterm_drain()
+    yield
+    # 不是经 SIGTERM 退出（比如 Ctrl+C）时也排空一次；已经排空过则立即返回
+    await run_in_threadpool(router.drain, DRAIN_TIMEOUT_SECONDS)
+    if INDEXER_ENABLED:
+        transfer_indexer.stop()
+    router.shutdown()
+
+
+app = FastAPI(title="x402 Relay Demo (Sepolia / USDC)", lifespan=lifespan)
 
 # ==== x402 配置 ====
 X402_VERSION = 1
 SCHEME = "eip3009-2auth"          # 自定义的 scheme：用两份 EIP-3009 授权完成 A->B + A->Service          # 自定义的 scheme，含义：用 txHash + 普通转账来证明已付款
-NETWORK = "eip155:11155111"         # Sepolia 的 CAIP-2 network id
 BASE_FEE = Decimal("0.01")          # 手续费
 MAX_TIMEOUT_SECONDS = 60            # 承诺多快完成代办
 
@@ -32,52 +111,104 @@ class RelayBody(BaseModel):
     amount: str
 
 
-def build_payment_required_response(resource_url: str, amount_human: str) -> dict:
-    w3 = get_web3()
-    relayer = get_relayer_account(w3)
-    token_addr = get_token_address()
-
-    amount_dec = Decimal(amount_human)
-    main_amount_atomic = human_to_token_amount(w3, token_addr, amount_dec)
-    fee_amount_atomic = human_to_token_amount(w3, token_addr, BASE_FEE)
+def draining_response() -> JSONResponse:
+    return JSONResponse(
+        status_code=503,
+        content={"error": "Server is draining, retry shortly", "retryAfter": DRAIN_RETRY_AFTER_SECONDS},
+        headers={"Retry-After": str(DRAIN_RETRY_AFTER_SECONDS)},
+    )
 
-    total_required_atomic = main_amount_atomic + fee_amount_atomic
 
-    payment_req = {
-        "scheme": SCHEME,
-        "network": NETWORK,
-        # 这里 maxAmountRequired 可以理解为：需要从 A 地址扣掉的总 token 数量
-        "maxAmountRequired": str(total_required_atomic),
-        "resource": resource_url,
-        "description": (
-            "Provide two EIP-3009 authorizations: "
-            "main(A->to_address, amount) and fee(A->service, BASE_FEE). "
-            "Relayer pays gas and broadcasts meta-txs."
-        ),
-        "mimeType": "application/json",
-        # payTo 可以理解为服务费的接收方
-        "payTo": relayer.address,
-        "maxTimeoutSeconds": MAX_TIMEOUT_SECONDS,
-        "asset": token_addr,
-        "extra": {
-            "name": "USDC",
-            "version": "1",
-            "mainAmountAtomic": str(main_amount_atomic),
-            "feeAtomic": str(fee_amount_atomic),
-            "serviceAddress": relayer.address,
-        },
-    }
+def build_payment_required_response(resource_url: str, amount_human: str) -> dict:
+    """
+    accepts 里列出所有支持的 (network, asset)；金额按各 token 自己的 decimals 换算（已缓存，不访问 RPC）
+    """
+    amount_dec = Decimal(amount_human)
+    accepts = []
+    for lane in router.all():
+        try:
+            main_amount_atomic = lane.human_to_atomic(amount_dec)
+            fee_amount_atomic = lane.human_to_atomic(BASE_FEE)
+        except Exception as e:
+            # 这条链暂时查不到 token 信息，先不报价，不影响其他链
+            print(f"[x402] skip {lane.network} {lane.asset}: {e}")
+            continue
+        accepts.append(lane.payment_requirement(
+            SCHEME, resource_url, main_amount_atomic, fee_amount_atomic, MAX_TIMEOUT_SECONDS,
+        ))
 
     return {
         "x402Version": X402_VERSION,
-        "accepts": [payment_req],
+        "accepts": accepts,
         "error": "",
     }
 
 
 @app.get("/")
 def root():
-    return {"msg": "x402-style relay server running"}
+    return {"msg": "x402-style relay server running", "draining": router.draining}
+
+
+def _check_admin_token(token: str | None):
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not token or not secrets.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+
+
+@app.post("/admin/drain")
+async def admin_drain(
+    wait: bool = Query(default=False, description="true 时等在途结算结束（最多 DRAIN_TIMEOUT_SECONDS）再返回"),
+    x_admin_token: str | None = Header(default=None, alias="X-Admin-Token"),
+):
+    """
+    进入排空：之后的付费请求回 503，报价照常。发布脚本可以轮询 GET /admin/drain 直到 in_flight=0 再停进程。
+    """
+    _check_admin_token(x_admin_token)
+    router.begin_drain()
+    recorded = 0
+    if wait:
+        recorded = await run_in_threadpool(router.drain, DRAIN_TIMEOUT_SECONDS)
+    return {**router.drain_status(), "recorded": recorded}
+
+
+@app.get("/admin/drain")
+def admin_drain_status(x_admin_token: str | None = Header(default=None, alias="X-Admin-Token")):
+    _check_admin_token(x_admin_token)
+    return router.drain_status()
+
+
+@app.get("/history/{address}")
+def history_endpoint(
+    address: str,
+    limit: int = Query(default=50, ge=1, le=500),
+    before: str | None = Query(default=None, description="上一页返回的 next_cursor"),
+):
+    """
+    某个地址经由本服务相关的 Transfer 记录（本地索引，按区块倒序分页），不访问 RPC。
+    """
+    if not INDEXER_ENABLED:
+        raise HTTPException(status_code=404, detail="Transfer index is disabled (INDEXER_ENABLED=false)")
+
+    before_key = None
+    if before:
+        try:
+            block, log_index = before.split(":")
+            before_key = (int(block), int(log_index))
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor, expected <blockNumber>:<logIndex>")
+
+    items = transfer_store.history(address, limit=limit, before=before_key)
+    next_cursor = None
+    if len(items) == limit:
+        next_cursor = f"{items[-1]['blockNumber']}:{items[-1]['logIndex']}"
+
+    return {
+        "address": address,
+        "items": items,
+        "next_cursor": next_cursor,
+        "indexed_to_block": transfer_store.get_meta("cursor"),
+    }
 
 
 @app.post("/relay")
@@ -91,10 +222,6 @@ async def relay_endpoint(
     - 如果没有 X-PAYMENT 头 → 返回 402 + PaymentRequiredResponse
     - 如果有 X-PAYMENT 头 → 解码 payload，校验两份授权 → 播两笔 meta-tx → 返回 200
     """
-    w3 = get_web3()
-    relayer = get_relayer_account(w3)
-    token_addr = get_token_address()
-
     resource_url = str(request.url)
 
     # 没有 X-PAYMENT 头：告诉你「需要两份 EIP-3009 授权」
@@ -102,6 +229,10 @@ async def relay_endpoint(
         pay_resp = build_payment_required_response(resource_url, body.amount)
         return JSONResponse(status_code=402, content=pay_resp)
 
+    # 排空中不再接新的结算（报价上面已经照常返回了）
+    if router.draining:
+        return draining_response()
+
     # 有 X-PAYMENT 头：解码并检查 PaymentPayload
     try:
         decoded = base64.b64decode(x_payment).decode("utf-8")
@@ -131,9 +262,11 @@ async def relay_endpoint(
         pay_resp["error"] = "Unsupported x402Version"
         return JSONResponse(status_code=402, content=pay_resp)
 
-    if payment_payload.get("scheme") != SCHEME or payment_payload.get("network") != NETWORK:
+    # 按 network（+ asset，同一条链上有多个 token 时必须带）找到结算通道
+    lane = router.get(payment_payload.get("network"), payment_payload.get("asset"))
+    if payment_payload.get("scheme") != SCHEME or lane is None:
         pay_resp = build_payment_required_response(resource_url, body.amount)
-        pay_resp["error"] = "Unsupported scheme or network"
+        pay_resp["error"] = "Unsupported scheme, network or asset"
         return JSONResponse(status_code=402, content=pay_resp)
 
     payload_inner = payment_payload.get("payload", {}) or {}
@@ -162,15 +295,15 @@ async def relay_endpoint(
         pay_resp = build_payment_required_response(resource_url, body.amount)
         pay_resp["error"] = "auth_main.to != body.to_address"
         return JSONResponse(status_code=402, content=pay_resp)
-    if auth_fee.get("to", "").lower() != relayer.address.lower():
+    if auth_fee.get("to", "").lower() != relayer_account.address.lower():
         pay_resp = build_payment_required_response(resource_url, body.amount)
         pay_resp["error"] = "auth_fee.to != relayer.address"
         return JSONResponse(status_code=402, content=pay_resp)
 
     # 3) 确认 value 金额正确（金额 = amount, 手续费 = BASE_FEE）
     amount_dec = Decimal(body.amount)
-    main_amount_atomic = human_to_token_amount(w3, token_addr, amount_dec)
-    fee_amount_atomic = human_to_token_amount(w3, token_addr, BASE_FEE)
+    main_amount_atomic = lane.human_to_atomic(amount_dec)
+    fee_amount_atomic = lane.human_to_atomic(BASE_FEE)
 
     if str(auth_main.get("value")) != str(main_amount_atomic):
         pay_resp = build_payment_required_response(resource_url, body.amount)
@@ -181,10 +314,60 @@ async def relay_endpoint(
         pay_resp["error"] = "auth_fee.value != expected fee"
         return JSONResponse(status_code=402, content=pay_resp)
 
+    # 登记为在途结算：从这里开始，排空会等它走完
+    settlement = router.admit(lane, auth_main, auth_fee)
+    if settlement is None:
+        return draining_response()
+
+    # 4) pre-flight：一次 RPC batch 确认余额够付本金+手续费、nonce 没用过、两笔都能模拟成功
+    preflight_ok = False
+    try:
+        await lane.run(preflight_two_auth, auth_main, auth_fee, lane.w3, lane.token)
+        preflight_ok = True
+    except PreflightError as e:
+        pay_resp = build_payment_required_response(resource_url, body.amount)
+        pay_resp["error"] = f"Preflight check failed: {e}"
+        return JSONResponse(status_code=402, content=pay_resp)
+    except Exception as e:
+        raise HTTPException(
+            status_code=503,
+            detail={
+                "msg": "Preflight RPC check unavailable",
+                "error": str(e),
+            },
+        )
+    finally:
+        # 交给 router.settle 之前 settlement 归本协程管：出错 / 被取消（CancelledError）都要释放
+        if not preflight_ok:
+            router.release(settlement)
+
     # ==== 授权校验通过 → relayer 播两笔 meta-tx ====
     try:
-        tx_result = relay_two_auth(auth_main, auth_fee)
+        # 广播 + 等回执是阻塞调用，放到该链自己的线程池里：不卡事件循环，也不占用其他链的线程
+        tx_result = await lane.run(router.settle, settlement)
+    except SettlementHandedOff:
+        # 排空到期：交易已广播但没等到回执，先把交易哈希告诉客户端（服务端也记录了，之后用 batch_relay 核对）
+        invalidate_balance(body.user_address, lane.asset)
+        return JSONResponse(
+            status_code=202,
+            content={
+                "ok": False,
+                "pending": True,
+                "message": (
+                    "Server is shutting down: meta-txs broadcast but not yet confirmed, "
+                    "check relayTxMain / relayTxFee on-chain"
+                    if settlement.tx_fee else
+                    "Server is shutting down: settlement recorded before all meta-txs were broadcast, "
+                    "the operator will complete it"
+                ),
+                "stage": settlement.stage,
+                "unconfirmed": settlement.unconfirmed,
+                "relayTxMain": settlement.tx_main,
+                "relayTxFee": settlement.tx_fee,
+            },
+        )
     except Exception as e:
+        invalidate_balance(body.user_address, lane.asset)
         raise HTTPException(
             status_code=500,
             detail={
@@ -193,11 +376,18 @@ async def relay_endpoint(
             },
         )
 
+    # 替这个付款人结算过，缓存的余额作废；并把他加入 Transfer 索引
+    invalidate_balance(body.user_address, lane.asset)
+    if INDEXER_ENABLED:
+        # SQLite 写入，别阻塞事件循环
+        await run_in_threadpool(transfer_indexer.watch, body.user_address)
+
     # 构造 X-PAYMENT-RESPONSE（也是 base64(JSON)）
     settlement = {
         "x402Version": X402_VERSION,
         "scheme": SCHEME,
-        "network": NETWORK,
+        "network": lane.network,
+        "asset": lane.asset,
         "relayTxMain": tx_result["tx_main"],
         "relayTxFee": tx_result["tx_fee"],
     }
@@ -0,0 +1,207 @@
+# batch_relay.py
+# 批量结算预先签好的授权：逐行读取 NDJSON（每行 {"auth_main": {...}, "auth_fee": {...}}，可带 network / asset），
+# 走和 /relay 相同的结算通道（settlement_router）做 pre-flight + relay_two_auth，限制并发，结果按完成顺序写到 NDJSON。
+# 中断后用同一个 --checkpoint 重跑会从断点继续，已完成的行不会重复结算。
+#
+#   python batch_relay.py auths.ndjson --out results.ndjson --concurrency 8
+#   python batch_relay.py pending_settlements.ndjson --resume-pending --out resumed.ndjson   # 补完网关排空时记录的结算
+import argparse
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from pydantic import ValidationError
+
+from gasless_api import RelayWithAuthRequest
+from settlement_router import RECEIPT_TIMEOUT_SECONDS
+from sign.eip3009_meta import settlement_lane
+from sign.eip3009_preflight import preflight_two_auth, invalidate_balance, PreflightError
+
+
+def settle_line(line_no: int, raw: str, preflight: bool = True) -> dict:
+    """
+    处理一行：解析 + 校验 → pre-flight → relay_two_auth
+    """
+    try:
+        req = RelayWithAuthRequest.model_validate_json(raw)
+    except ValidationError as e:
+        return {"line": line_no, "ok": False, "error": f"invalid line: {e.errors(include_url=False)}"}
+
+    auth_main = req.auth_main.to_dict()
+    auth_fee = req.auth_fee.to_dict()
+
+    try:
+        lane = settlement_lane(req.network, req.asset)
+    except RuntimeError as e:
+        return {"line": line_no, "ok": False, "error": str(e)}
+
+    try:
+        if preflight:
+            preflight_two_auth(auth_main, auth_fee, lane.w3, lane.token)
+        result = lane.relay_two_auth(auth_main, auth_fee)
+    except PreflightError as e:
+        return {"line": line_no, "ok": False, "error": f"preflight: {e}"}
+    except Exception as e:
+        invalidate_balance(auth_main["from"], lane.asset)
+        return {"line": line_no, "ok": False, "error": str(e)}
+
+    invalidate_balance(auth_main["from"], lane.asset)
+    return {"line": line_no, "ok": True, **result}
+
+
+def resume_pending_line(line_no: int, raw: str) -> dict:
+    """
+    补完 app_x402 排空时记下的一笔结算（PENDING_SETTLEMENTS_FILE 的一行）：
+    已广播的那一笔只等回执，没广播的才用原授权广播；本金那笔失败就不再收手续费
+    """
+    try:
+        record = json.loads(raw)
+        lane = settlement_lane(record["network"], record["asset"])
+        auths = {"main": record["auth_main"], "fee": record["auth_fee"]}
+        payer = auths["main"]["from"]
+    except Exception as e:
+        return {"line": line_no, "ok": False, "error": f"invalid pending record: {e!r}"}
+
+    result = {"line": line_no}
+    try:
+        for leg in ("main", "fee"):
+            tx_hash = record.get(f"tx_{leg}")
+            if tx_hash:
+                receipt = lane.w3.eth.wait_for_transaction_receipt(tx_hash, timeout=RECEIPT_TIMEOUT_SECONDS)
+                if receipt.status != 1:
+                    raise RuntimeError(f"{leg} meta-tx {tx_hash} failed")
+            else:
+                tx_hash = lane.relay_with_authorization(auths[leg], leg=leg)
+            result[f"tx_{leg}"] = tx_hash
+    except Exception as e:
+        return {**result, "ok": False, "error": str(e)}
+    finally:
+        invalidate_balance(payer, lane.asset)
+
+    return {**result, "ok": True}
+
+
+class Checkpoint:
+    """
+    断点：next_line 之前的行全部完成。
+    并发下完成顺序是乱的，next_line 之后已完成的行只记在内存里（最多 concurrency 个），
+    续跑时再从结果文件里找回来，所以内存占用和文件大小无关。
+    """
+
+    def __init__(self, path: str, out_path: str):
+        self.path = path
+        self.next_line = 0
+        self.done_ahead: set[int] = set()
+        self.lock = threading.Lock()
+
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                self.next_line = int(json.load(f).get("next_line", 0))
+        # 结果文件里 >= next_line 的行是上次中断前已经完成、但还没推进到断点里的
+        if os.path.exists(out_path):
+            with open(out_path, "r", encoding="utf-8") as f:
+                for raw in f:
+                    try:
+                        line_no = json.loads(raw)["line"]
+                    except Exception:
+                        continue
+                    if line_no >= self.next_line:
+                        self.done_ahead.add(line_no)
+        self._advance()
+
+    def _advance(self):
+        while self.next_line in self.done_ahead:
+            self.done_ahead.remove(self.next_line)
+            self.next_line += 1
+
+    def is_done(self, line_no: int) -> bool:
+        with self.lock:
+            return line_no < self.next_line or line_no in self.done_ahead
+
+    def mark_done(self, line_no: int):
+        with self.lock:
+            self.done_ahead.add(line_no)
+            self._advance()
+
+    def save(self):
+        with self.lock:
+            tmp = self.path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({"next_line": self.next_line}, f)
+            os.replace(tmp, self.path)
+
+
+def run(args):
+    checkpoint = Checkpoint(args.checkpoint or args.out + ".ckpt", args.out)
+    # 同时在途的行数上限：读文件的速度受它约束，内存恒定
+    slots = threading.BoundedSemaphore(args.concurrency)
+    out_lock = threading.Lock()
+    stats = {"ok": 0, "failed": 0, "skipped": 0}
+    completed = [0]
+
+    with open(args.out, "a", encoding="utf-8") as out, \
+            ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+
+        def on_done(line_no: int, result: dict):
+            with out_lock:
+                out.write(json.dumps(result, ensure_ascii=False) + "\n")
+                out.flush()
+                stats["ok" if result["ok"] else "failed"] += 1
+                completed[0] += 1
+                save_now = completed[0] % args.checkpoint_every == 0
+            checkpoint.mark_done(line_no)
+            if save_now:
+                checkpoint.save()
+
+        def work(line_no: int, raw: str):
+            try:
+                try:
+                    if args.resume_pending:
+                        result = resume_pending_line(line_no, raw)
+                    else:
+                        result = settle_line(line_no, raw, preflight=not args.no_preflight)
+                except Exception as e:
+                    # 任何意外异常都记成失败结果：on_done 一定要调到，否则断点会一直卡在这一行
+                    result = {"line": line_no, "ok": False, "error": f"unexpected error: {e!r}"}
+                on_done(line_no, result)
+            finally:
+                slots.release()
+
+        try:
+            with open(args.input, "r", encoding="utf-8") as f:
+                for line_no, raw in enumerate(f):
+                    raw = raw.strip()
+                    if not raw or checkpoint.is_done(line_no):
+                        if raw:
+                            stats["skipped"] += 1
+                        else:
+                            checkpoint.mark_done(line_no)
+                        continue
+                    slots.acquire()
+                    pool.submit(work, line_no, raw)
+        except KeyboardInterrupt:
+            print("Interrupted, waiting for in-flight settlements to finish...")
+        finally:
+            pool.shutdown(wait=True)
+            checkpoint.save()
+
+    print(
+        f"done: ok={stats['ok']} failed={stats['failed']} skipped(already done)={stats['skipped']}, "
+        f"checkpoint next_line={checkpoint.next_line}"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Settle pre-signed auth_main/auth_fee pairs from an NDJSON file")
+    parser.add_argument("input", help="NDJSON 文件，每行 {\"auth_main\": {...}, \"auth_fee\": {...}}")
+    parser.add_argument("--out", required=True, help="结果 NDJSON（追加写）")
+    parser.add_argument("--checkpoint", default=None, help="断点文件，默认 <out>.ckpt")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--checkpoint-every", type=int, default=20)
+    parser.add_argument("--no-preflight", action="store_true", help="跳过广播前的余额 / nonce / 模拟检查")
+    parser.add_argument(
+        "--resume-pending", action="store_true",
+        help="输入是 app_x402 排空时写的 PENDING_SETTLEMENTS_FILE：已广播的只核对回执，没广播的才补发",
+    )
+    run(parser.parse_args())
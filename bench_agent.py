@@ -0,0 +1,165 @@
+# bench_agent.py
+# 离线 agent 基准 / 回归：假模型（脚本化 tool call）+ 假 x402_relay，不连 OpenAI、不连 /relay，
+# 跑大量“两步走”对话，测 LangGraph 本身的开销：每轮框架耗时、每个线程占多少内存、checkpointer 花了多少时间。
+#   python bench_agent.py --sessions 2000
+#   python bench_agent.py --sessions 500 --max-p95-ms 20 --max-bytes-per-thread 200000   # 超过阈值退出码 1
+#   python bench_agent.py --sessions 1000 --compare   # 一半会话走快速通道、一半走完整 agent，报告省下的耗时 / token
+import argparse
+import contextlib
+import json
+import os
+import resource
+import statistics
+import sys
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+from langgraph.checkpoint.memory import MemorySaver
+
+from llm.checkpointer import BoundedMemorySaver
+from llm.fakes import conversation_turns, install_offline_agent, percentile
+
+
+def instrument_checkpointer(saver) -> dict:
+    """
+    给 checkpointer 的读写方法套上计时，返回 {方法名: [次数, 总秒数]}（--workers > 1 时多线程累加，要加锁）
+    """
+    timings = {}
+    lock = threading.Lock()
+    for name in ("get_tuple", "put", "put_writes"):
+        original = getattr(saver, name)
+        timings[name] = [0, 0.0]
+
+        def wrapped(*args, _original=original, _name=name, **kwargs):
+            t0 = time.perf_counter()
+            try:
+                return _original(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - t0
+                with lock:
+                    timings[_name][0] += 1
+                    timings[_name][1] += elapsed
+
+        setattr(saver, name, wrapped)
+    return timings
+
+
+def run_conversation(agent_mod, i: int, graph_only: bool) -> tuple[list, str | None]:
+    """
+    一个两步对话；返回 (每轮耗时, 出错信息)
+    graph_only=True 时第二步也走完整 agent（不走快速通道），只测图本身
+    """
+    session_id = f"bench-{i}"
+    durations = []
+    reply = ""
+    for message in conversation_turns(i):
+        t0 = time.perf_counter()
+        reply = agent_mod.chat(session_id, message, fast_path=not graph_only)
+        durations.append(time.perf_counter() - t0)
+
+    if "relayTxMain=0x" not in reply:
+        return durations, f"{session_id}: unexpected final reply {reply!r}"
+    return durations, None
+
+
+def main(args) -> int:
+    if args.checkpointer == "memory":
+        saver = MemorySaver()
+    else:
+        saver = BoundedMemorySaver(max_threads=args.sessions + 2, max_bytes=1 << 40)
+    timings = instrument_checkpointer(saver)
+    agent_mod = install_offline_agent(checkpointer=saver)
+
+    # 预热：第一次调用有 import / 编译等一次性开销；用正常的会话编号，保证走到工具 / 快速通道
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        run_conversation(agent_mod, args.sessions, args.graph_only)
+        if args.compare:
+            run_conversation(agent_mod, args.sessions + 1, True)
+    for t in timings.values():
+        t[0], t[1] = 0, 0.0
+    for stats in (agent_mod.FAST_PATH_STATS, agent_mod.AGENT_PATH_STATS):
+        for key in stats:
+            stats[key] = 0
+
+    if args.trace_memory:
+        tracemalloc.start()
+    mem_before = tracemalloc.get_traced_memory()[0] if args.trace_memory else 0
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    durations, errors = [], []
+    t0 = time.perf_counter()
+    # agent 里每轮的 [context] / [fast-path] 日志在这里只是噪音
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull), \
+            ThreadPoolExecutor(max_workers=args.workers) as pool:
+        for turn_durations, error in pool.map(
+            lambda i: run_conversation(agent_mod, i, args.graph_only or (args.compare and i % 2 == 1)),
+            range(args.sessions),
+        ):
+            durations += turn_durations
+            if error:
+                errors.append(error)
+    elapsed = time.perf_counter() - t0
+
+    mem_after = tracemalloc.get_traced_memory()[0] if args.trace_memory else 0
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    turns = len(durations)
+    p95_ms = percentile(durations, 0.95) * 1000
+    checkpointer_seconds = sum(t[1] for t in timings.values())
+
+    print(f"sessions: {args.sessions}, turns: {turns}, workers: {args.workers}, "
+          f"checkpointer: {args.checkpointer}, graph only: {args.graph_only}, compare: {args.compare}")
+    print(f"elapsed: {elapsed:.2f}s, turns/s: {turns / elapsed:.0f}, errors: {len(errors)}")
+    print(f"per-turn overhead ms: p50={statistics.median(durations) * 1000:.2f} p95={p95_ms:.2f} "
+          f"p99={percentile(durations, 0.99) * 1000:.2f}")
+    print(f"checkpointer: {checkpointer_seconds / turns * 1000:.3f} ms/turn "
+          f"({checkpointer_seconds / sum(durations) * 100:.1f}% of turn time)")
+    for name, (count, seconds) in timings.items():
+        if count:
+            print(f"  {name}: {count} calls, avg {seconds / count * 1e6:.1f} us")
+
+    bytes_per_thread = None
+    if args.trace_memory:
+        bytes_per_thread = (mem_after - mem_before) / args.sessions
+        print(f"python heap growth per thread: {bytes_per_thread:.0f} bytes")
+    if hasattr(saver, "stats"):
+        stats = saver.stats()
+        print(f"checkpointer stats: {stats}")
+        bytes_per_thread = bytes_per_thread or stats.get("bytes_per_thread")
+    print(f"max RSS growth: {(rss_after - rss_before) / 1024:.1f} MB")
+    # 提交授权那一轮：快速通道 vs 完整 agent
+    print("paths:", json.dumps(agent_mod.path_stats(), ensure_ascii=False))
+
+    failed = False
+    if errors:
+        print("FAIL: wrong replies, e.g.", errors[0])
+        failed = True
+    if args.max_p95_ms and p95_ms > args.max_p95_ms:
+        print(f"FAIL: p95 {p95_ms:.2f}ms > {args.max_p95_ms}ms")
+        failed = True
+    if args.max_bytes_per_thread and bytes_per_thread is None:
+        print("FAIL: --max-bytes-per-thread given but bytes/thread was not measured")
+        failed = True
+    elif args.max_bytes_per_thread and bytes_per_thread > args.max_bytes_per_thread:
+        print(f"FAIL: {bytes_per_thread:.0f} bytes/thread > {args.max_bytes_per_thread}")
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline benchmark / regression suite for the llm.agent loop")
+    parser.add_argument("--sessions", type=int, default=1000, help="对话线程数（每个线程两轮）")
+    parser.add_argument("--workers", type=int, default=1, help="同时跑几个对话")
+    parser.add_argument("--checkpointer", choices=["bounded", "memory"], default="bounded")
+    parser.add_argument("--graph-only", action="store_true", help="第二步也走完整 agent，不走快速通道")
+    parser.add_argument("--compare", action="store_true", help="奇数会话走完整 agent，和快速通道对比")
+    parser.add_argument("--trace-memory", action="store_true", help="用 tracemalloc 统计堆增长（会变慢）")
+    parser.add_argument("--max-p95-ms", type=float, default=0, help="每轮 p95 超过该值则失败")
+    parser.add_argument("--max-bytes-per-thread", type=float, default=0, help="每线程内存超过该值则失败")
+    args = parser.parse_args()
+    if args.max_bytes_per_thread and args.checkpointer == "memory" and not args.trace_memory:
+        # MemorySaver 没有 stats()，不开 tracemalloc 就量不到每线程内存，阈值会被悄悄跳过
+        parser.error("--max-bytes-per-thread with --checkpointer memory needs --trace-memory")
+    sys.exit(main(args))
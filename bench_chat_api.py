@@ -0,0 +1,56 @@
+# bench_chat_api.py
+# 离线压测 chat_api：假模型 + 假 /relay，进程内 ASGI 调用，看单 worker 能扛多少并发会话、每轮延迟多少
+#   python bench_chat_api.py --sessions 500 --concurrency 100 --llm-latency 0.3
+import argparse
+import asyncio
+import statistics
+import time
+
+import httpx
+
+from llm.fakes import conversation_turns, install_offline_agent, percentile
+
+
+async def run_session(client: httpx.AsyncClient, i: int, latencies: list, errors: list):
+    session_id = f"bench-{i}"
+    for message in conversation_turns(i):
+        t0 = time.perf_counter()
+        resp = await client.post("/chat", json={"session_id": session_id, "message": message})
+        latencies.append(time.perf_counter() - t0)
+        if resp.status_code != 200 or resp.json().get("code") != 0:
+            errors.append(resp.text)
+
+
+async def main(args):
+    agent_mod = install_offline_agent(args.llm_latency, args.tool_latency)
+    import chat_api
+
+    sem = asyncio.Semaphore(args.concurrency)
+    latencies, errors = [], []
+
+    async def bounded(i):
+        async with sem:
+            await run_session(client, i, latencies, errors)
+
+    transport = httpx.ASGITransport(app=chat_api.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://chat", timeout=None) as client:
+        t0 = time.perf_counter()
+        await asyncio.gather(*(bounded(i) for i in range(args.sessions)))
+        elapsed = time.perf_counter() - t0
+
+    print(f"sessions: {args.sessions}, concurrency: {args.concurrency}, "
+          f"llm latency: {args.llm_latency}s, tool latency: {args.tool_latency}s")
+    print(f"elapsed: {elapsed:.2f}s, sessions/s: {args.sessions / elapsed:.1f}, errors: {len(errors)}")
+    print(f"turn latency ms: p50={statistics.median(latencies) * 1000:.1f} "
+          f"p95={percentile(latencies, 0.95) * 1000:.1f} p99={percentile(latencies, 0.99) * 1000:.1f}")
+    if hasattr(agent_mod.checkpointer, "stats"):
+        print("checkpointer:", agent_mod.checkpointer.stats())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sessions", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--llm-latency", type=float, default=0.2)
+    parser.add_argument("--tool-latency", type=float, default=0.1)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,174 @@
+# bench_rpc_provider.py
+# 离线检查 rpc_provider.MultiEndpointProvider：本地起几个假 JSON-RPC 节点（http.server），注入延迟 / 报错 / 限流，
+# 验证路由（读请求走最快的节点）、对冲（主节点超过 p95 没回来就发给下一个）、故障切换 + 冷却、
+# 错误率随时间衰减（恢复的节点不会被永久排除）、广播。
+#   python bench_rpc_provider.py
+# 任何一项检查不通过退出码 1
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+os.environ.setdefault("RPC_COOLDOWN_SECONDS", "1")
+os.environ.setdefault("RPC_TIMEOUT", "5")
+os.environ.setdefault("RPC_ERROR_HALF_LIFE_SECONDS", "0.5")
+
+from rpc_provider import MultiEndpointProvider, RPC_HEDGE_MIN_DELAY
+
+
+class StubNode:
+    """
+    一个假节点：eth_blockNumber 返回自己的编号，eth_sendRawTransaction 返回固定哈希；
+    delay / mode 可以随时改（mode: ok / http_error / rate_limit）
+    """
+
+    def __init__(self, index: int, delay: float = 0.0):
+        self.index = index
+        self.delay = delay
+        self.mode = "ok"
+        self.calls = Counter()
+        node = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                requests = request if isinstance(request, list) else [request]
+                for item in requests:
+                    node.calls[item["method"]] += 1
+                time.sleep(node.delay)
+
+                if node.mode == "http_error":
+                    self.send_response(500)
+                    self.end_headers()
+                    return
+                responses = [node.respond(item) for item in requests]
+                body = json.dumps(responses if isinstance(request, list) else responses[0]).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def respond(self, item: dict) -> dict:
+        if self.mode == "rate_limit":
+            return {"jsonrpc": "2.0", "id": item["id"], "error": {"code": 429, "message": "Too Many Requests"}}
+        if item["method"] == "eth_sendRawTransaction":
+            return {"jsonrpc": "2.0", "id": item["id"], "result": "0x" + "ab" * 32}
+        return {"jsonrpc": "2.0", "id": item["id"], "result": hex(self.index)}
+
+
+def answered_by(provider: MultiEndpointProvider) -> int:
+    return int(provider.make_request("eth_blockNumber", [])["result"], 16)
+
+
+def warmed_provider(nodes: list) -> MultiEndpointProvider:
+    """
+    每个场景一个新 provider（统计互不影响），先跑一批读请求攒够延迟样本
+    """
+    for node in nodes:
+        node.mode = "ok"
+    provider = MultiEndpointProvider([node.url for node in nodes])
+    for _ in range(60):
+        answered_by(provider)
+    return provider
+
+
+def check(results: list, name: str, ok: bool, detail: str):
+    results.append(ok)
+    print(f"[{'PASS' if ok else 'FAIL'}] {name}: {detail}")
+
+
+def main() -> int:
+    nodes = [StubNode(0, delay=0.005), StubNode(1, delay=0.04), StubNode(2, delay=0.08)]
+    results = []
+
+    # 1) 路由：预热出延迟样本后，读请求基本都落在最快的节点上
+    provider = warmed_provider(nodes)
+    served = Counter(answered_by(provider) for _ in range(50))
+    check(results, "routing", served[0] >= 45, f"last 50 reads served by {dict(served)}")
+
+    # 2) 对冲：主节点突然变慢，应在它的 p95（外加第二个节点的延迟）后由第二个节点回答，而不是等满 0.5s
+    provider = warmed_provider(nodes)
+    hedge_delay = provider.endpoints[0].p95()
+    nodes[0].delay = 0.5
+    t0 = time.perf_counter()
+    winner = answered_by(provider)
+    elapsed = time.perf_counter() - t0
+    check(
+        results, "hedge",
+        winner != 0 and elapsed < hedge_delay + nodes[2].delay + 0.15,
+        f"answered by node {winner} in {elapsed * 1000:.0f}ms (hedge delay {hedge_delay * 1000:.0f}ms)",
+    )
+    nodes[0].delay = 0.005
+    time.sleep(0.6)  # 等对冲出去的慢请求回来
+
+    # 3) 故障切换：主节点 HTTP 500，每次读都应由其他节点回答；连续失败 3 次后进入冷却、排到最后
+    provider = warmed_provider(nodes)
+    nodes[0].mode = "http_error"
+    served = Counter(answered_by(provider) for _ in range(5))
+    cooled = not provider.endpoints[0].healthy() and provider.ranked()[-1] is provider.endpoints[0]
+    check(results, "failover", served[0] == 0 and cooled, f"reads served by {dict(served)}, node 0 cooled down: {cooled}")
+
+    # 冷却结束、节点恢复后重新被使用
+    nodes[0].mode = "ok"
+    time.sleep(float(os.environ["RPC_COOLDOWN_SECONDS"]) + 0.1)
+    served = Counter(answered_by(provider) for _ in range(20))
+    check(results, "recovery", served[0] > 0, f"after cooldown reads served by {dict(served)}")
+
+    # 错误率远超阈值的节点：没有请求打到它，错误率也会按半衰期降下来，重新被使用
+    provider = warmed_provider(nodes)
+    for _ in range(10):
+        provider.endpoints[0].record_failure()
+    excluded = not provider.endpoints[0].healthy()
+    time.sleep(max(float(os.environ["RPC_COOLDOWN_SECONDS"]), 4 * float(os.environ["RPC_ERROR_HALF_LIFE_SECONDS"])) + 0.1)
+    served = Counter(answered_by(provider) for _ in range(20))
+    check(
+        results, "error decay", excluded and served[0] > 0,
+        f"excluded at error rate >0.5: {excluded}, after decay reads served by {dict(served)}",
+    )
+
+    # 4) 限流：429 当作节点故障换节点，不把错误返回给调用方
+    provider = warmed_provider(nodes)
+    nodes[1].mode = "rate_limit"
+    nodes[0].mode = "rate_limit"
+    response = provider.make_request("eth_blockNumber", [])
+    check(results, "rate limit", response.get("result") == hex(2), f"response {response}")
+
+    # 5) 广播：发给所有节点；写请求的耗时不进读请求的延迟样本
+    provider = warmed_provider(nodes)
+    before = [len(ep.samples) for ep in provider.endpoints]
+    sent_before = [node.calls["eth_sendRawTransaction"] for node in nodes]
+    response = provider.make_request("eth_sendRawTransaction", ["0x00"])
+    time.sleep(max(node.delay for node in nodes) + 0.1)
+    reached = [node.calls["eth_sendRawTransaction"] - n for node, n in zip(nodes, sent_before)]
+    after = [len(ep.samples) for ep in provider.endpoints]
+    check(
+        results, "broadcast",
+        "result" in response and reached == [1, 1, 1] and after == before,
+        f"reached {reached}, read samples before/after {before}/{after}",
+    )
+
+    # 6) batch 请求走同一套读路由
+    batch = provider.make_batch_request([("eth_blockNumber", []), ("eth_blockNumber", [])])
+    check(results, "batch", isinstance(batch, list) and len(batch) == 2, f"{batch}")
+
+    print("stats:", json.dumps(provider.stats()))
+    print(f"hedge min delay: {RPC_HEDGE_MIN_DELAY * 1000:.0f}ms")
+    for node in nodes:
+        node.server.shutdown()
+    return 0 if all(results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,15 +2,23 @@
 from web3 import Web3
 from dotenv import load_dotenv
 import os
+from rpc_provider import make_provider
 load_dotenv("properties.env")
 
+# 进程内共用一个 provider：连接复用，多节点时的延迟 / 错误统计也能累积
+_provider = None
+
 
 def get_web3():
+    global _provider
     rpc_url = os.getenv("RPC_URL_SEPOLIA")
     if not rpc_url:
         raise RuntimeError("RPC_URL_SEPOLIA not set in .env")
 
-    w3 = Web3(Web3.HTTPProvider(rpc_url))
+    if _provider is None:
+        # RPC_URL_SEPOLIA 可以用逗号分隔配多个节点
+        _provider = make_provider(rpc_url)
+    w3 = Web3(_provider)
     if not w3.is_connected():
         raise RuntimeError("Web3 not connected, check RPC_URL_SEPOLIA")
     return w3
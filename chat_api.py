@@ -0,0 +1,111 @@
+# chat_api.py
+import json
+import asyncio
+from contextlib import asynccontextmanager
+
+from fastapi import FastAPI
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
+
+from llm.agent import achat, astream_chat, checkpointer, path_stats
+from llm.llm_tools import aclose_clients, x402_inprocess_lifespan
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # X402_INPROCESS=true 时网关跑在本进程里，它的启动 / 排空也要跟着本服务走
+    async with x402_inprocess_lifespan():
+        yield
+        await aclose_clients()
+
+
+app = FastAPI(title="x402 Chat Service", lifespan=lifespan)
+
+
+class ChatRequest(BaseModel):
+    session_id: str   # 对话线程 id
+    message: str      # 这一轮用户说的话
+
+
+# ==== 按 thread_id 串行 ====
+# 同一个线程的两条消息不能同时跑（会在 checkpointer 上互相覆盖），不同线程之间并行。
+# 锁用完（没人在等）就删掉，线程数再多也不会堆积。
+_thread_locks: dict[str, asyncio.Lock] = {}
+_thread_waiters: dict[str, int] = {}
+
+
+@asynccontextmanager
+async def thread_lock(session_id: str):
+    lock = _thread_locks.setdefault(session_id, asyncio.Lock())
+    _thread_waiters[session_id] = _thread_waiters.get(session_id, 0) + 1
+    try:
+        async with lock:
+            yield
+    finally:
+        _thread_waiters[session_id] -= 1
+        if _thread_waiters[session_id] == 0:
+            del _thread_waiters[session_id]
+            del _thread_locks[session_id]
+
+
+@app.get("/")
+def root():
+    return {"msg": "x402 chat service running"}
+
+
+@app.post("/chat")
+async def chat_endpoint(req: ChatRequest):
+    """
+    一问一答：等这一轮（含工具调用）跑完再返回完整回复
+    """
+    async with thread_lock(req.session_id):
+        try:
+            reply = await achat(req.session_id, req.message)
+        except Exception as e:
+            return {
+                "code": 1,
+                "error": str(e),
+            }
+
+    return {
+        "code": 0,
+        "data": {
+            "session_id": req.session_id,
+            "reply": reply,
+        },
+    }
+
+
+@app.post("/chat/stream")
+async def chat_stream_endpoint(req: ChatRequest):
+    """
+    流式：按 NDJSON 逐行返回事件（token / tool_start / tool_end，格式见 llm.agent._to_events），
+    最后一行是 {"type": "done"} 或 {"type": "error", ...}
+    """
+
+    async def events():
+        async with thread_lock(req.session_id):
+            try:
+                async for event in astream_chat(req.session_id, req.message):
+                    yield json.dumps(event, ensure_ascii=False) + "\n"
+            except Exception as e:
+                yield json.dumps({"type": "error", "error": str(e)}, ensure_ascii=False) + "\n"
+                return
+        yield json.dumps({"type": "done"}) + "\n"
+
+    return StreamingResponse(events(), media_type="application/x-ndjson")
+
+
+@app.get("/chat/stats")
+def chat_stats():
+    """
+    当前活跃线程锁数量 + checkpointer 的统计 + 快速通道 / 完整 agent 的耗时和 token 对比
+    """
+    return {
+        "code": 0,
+        "data": {
+            "active_threads": len(_thread_locks),
+            "checkpointer": checkpointer.stats() if hasattr(checkpointer, "stats") else {},
+            "paths": path_stats(),
+        },
+    }
@@ -2,7 +2,7 @@
 import streamlit as st
 import uuid
 
-from llm.agent import chat
+from llm.agent import stream_chat
 
 st.set_page_config(page_title="x402 Web3 Chat")
 
@@ -41,15 +41,29 @@ if user_input:
     with st.chat_message("user"):
         st.markdown(user_input)
 
-    # 3.2 调用后端 LLM agent
+    # 3.2 调用后端 LLM agent（流式：token 到一个渲染一个，工具调用单独显示进度）
     with st.chat_message("assistant"):
-        with st.spinner("思考中..."):
-            try:
-                reply = chat(st.session_state["thread_id"], user_input)
-            except Exception as e:
-                reply = f"调用后端出错了：{e}"
+        placeholder = st.empty()
+        reply = ""
+        status = None
+        try:
+            for event in stream_chat(st.session_state["thread_id"], user_input):
+                if event["type"] == "token":
+                    reply += event["content"]
+                    placeholder.markdown(reply + "▌")
+                elif event["type"] == "tool_start":
+                    if reply:
+                        placeholder.markdown(reply)
+                    status = st.status(f"正在调用工具 {event['name']} ...", expanded=False)
+                    # 工具调用之后模型会重新组织一段新回复
+                    reply = ""
+                    placeholder = st.empty()
+                elif event["type"] == "tool_end" and status is not None:
+                    status.update(label=f"工具 {event['name']} 已返回", state="complete")
+        except Exception as e:
+            reply = f"调用后端出错了：{e}"
 
-            st.markdown(reply)
+        placeholder.markdown(reply)
 
     # 3.3 把助手回复也写入历史
     st.session_state["messages"].append({
@@ -1,12 +1,16 @@
 # gasless_api.py
+import json
 from fastapi import FastAPI
-from pydantic import BaseModel
+from fastapi.concurrency import iterate_in_threadpool
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, ConfigDict, Field
 from typing import Optional
 from sign.eip3009_meta import (
     user_account,
     relayer_account,
     human_to_atomic,
     build_transfer_authorization,
+    iter_bulk_authorizations,
     relay_two_auth,
 )
 
@@ -60,8 +64,49 @@ def build_auth_demo(req: BuildAuthDemoRequest):
         },
     }
 
+class BulkRecipient(BaseModel):
+    to_addr: str                      # 收款人
+    amount: str                       # 本金（人类单位）
+
+
+class BuildAuthBulkRequest(BaseModel):
+    from_addr: Optional[str] = None   # 不传就用 user_account
+    recipients: list[BulkRecipient]
+    fee: str = "0.01"                 # 每笔的手续费（人类单位）
+    stream: bool = False              # true 则按 NDJSON 一行一对流式返回
+
+
+@app.post("/build_auth_bulk")
+def build_auth_bulk(req: BuildAuthBulkRequest):
+    """
+    批量版 build_auth_demo：每个收款人签一对 auth_main / auth_fee。
+    用于生成压测数据、批量打款。大批量时在进程池里并行签名。
+    """
+    from_addr = req.from_addr or user_account.address
+    items = [(r.to_addr, human_to_atomic(r.amount)) for r in req.recipients]
+    pairs = iter_bulk_authorizations(items, from_addr=from_addr, fee_atomic=human_to_atomic(req.fee))
+
+    if req.stream:
+        lines = (json.dumps(pair) + "\n" for pair in pairs)
+        return StreamingResponse(iterate_in_threadpool(lines), media_type="application/x-ndjson")
+
+    return {
+        "code": 0,
+        "data": {
+            "from": from_addr,
+            "to_service": relayer_account.address,
+            "fee": req.fee,
+            "count": len(items),
+            "pairs": list(pairs),
+        },
+    }
+
+
 class AuthPayload(BaseModel):
-    from_: str
+    # JSON 里字段名是 "from"（和 build_transfer_authorization 的输出一致），也兼容 "from_"
+    model_config = ConfigDict(populate_by_name=True)
+
+    from_: str = Field(alias="from")
     to: str
     value: str
     validAfter: str
@@ -88,6 +133,8 @@ class AuthPayload(BaseModel):
 class RelayWithAuthRequest(BaseModel):
     auth_main: AuthPayload   # A -> B
     auth_fee: AuthPayload    # A -> Service
+    network: Optional[str] = None   # 结算通道（CAIP-2），不传用默认链
+    asset: Optional[str] = None     # 同一条链上有多个 token 时必须带
 
 
 @app.post("/relay_with_auth")
@@ -101,7 +148,7 @@ def relay_with_auth(req: RelayWithAuthRequest):
     auth_fee = req.auth_fee.to_dict()
 
     try:
-        result = relay_two_auth(auth_main, auth_fee)
+        result = relay_two_auth(auth_main, auth_fee, req.network, req.asset)
         return {
             "code": 0,
             "data": result,
@@ -1,13 +1,20 @@
 # llm_agent.py
+import asyncio
 import json
 import os
+import threading
+import time
+import uuid
+from collections import deque
 from pathlib import Path
 
 from langchain_openai import ChatOpenAI
-from langchain_core.messages import HumanMessage, SystemMessage
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage, ToolMessage
 from llm.llm_tools import x402_relay_tool
 from langchain.agents import create_agent
-from langgraph.checkpoint.memory import MemorySaver
+from langchain.agents.middleware import AgentMiddleware
+from llm.checkpointer import make_checkpointer
+from llm.context import ContextBudgetMiddleware
 from dotenv import load_dotenv
 
 # 当前文件 llm/chat.py -> parents[1] 就是 project_root
@@ -92,13 +99,16 @@ SYSTEM_PROMPT = """
     to_address   = B  
     amount       = 本金  
     payload_json = 用户提供的 JSON 字符串（必须原样）
+    network      = 第一步 402 返回里的 network
+    asset        = 第一步 402 返回里的 asset
 
 工具会自动：
  - 将此作为 payload 包装成完整 X-402 JSON：
      {
         "x402Version": 1,
         "scheme": "eip3009-2auth",
-        "network": "eip155:11155111",
+        "network": network,
+        "asset": asset,
         "payload": {auth_main, auth_fee}
      }
  - 进行 JSON → base64
@@ -144,12 +154,420 @@ SYSTEM_PROMPT = """
 llm = ChatOpenAI(
         model="gpt-5-nano",
     )
-checkpointer = MemorySaver()  # 自动按 thread_id 存历史
+checkpointer = make_checkpointer()  # 自动按 thread_id 存历史（带 LRU / TTL 淘汰，可选 SQLite 持久化）
+
+# 全进程同时在跑的 LLM 调用数上限（并发服务里防止打爆模型接口的速率限制）
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "16"))
+
+
+class LLMSlots:
+    """
+    同步调用（线程）和异步调用（任意事件循环）共用的一组 LLM 并发名额，`with` / `async with` 都能用。
+    名额满了按先来后到排队；释放时名额直接交给队头：线程用 Event 唤醒，
+    协程用它自己那个事件循环上的 future（call_soon_threadsafe 投递），不会绑死在某一个 loop 上。
+    """
+
+    def __init__(self, limit: int):
+        self._limit = limit
+        self._used = 0
+        self._lock = threading.Lock()
+        self._waiters = deque()
+
+    def acquire(self) -> None:
+        with self._lock:
+            if self._used < self._limit and not self._waiters:
+                self._used += 1
+                return
+            granted = threading.Event()
+            self._waiters.append(granted)
+        granted.wait()
+
+    async def aacquire(self) -> None:
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self._used < self._limit and not self._waiters:
+                self._used += 1
+                return
+            granted = loop.create_future()
+            self._waiters.append(granted)
+        try:
+            await granted
+        except BaseException:
+            with self._lock:
+                if granted in self._waiters:
+                    # 还没轮到就被取消了，不占名额
+                    self._waiters.remove(granted)
+                    raise
+            if granted.done() and not granted.cancelled():
+                # 名额已经交过来了，但协程被取消：还回去
+                self.release()
+            # 否则名额正在投递途中，_deliver 看到 future 已取消会自己还回去
+            raise
+
+    def _deliver(self, granted: asyncio.Future) -> None:
+        if granted.cancelled():
+            self.release()
+        else:
+            granted.set_result(None)
+
+    def release(self) -> None:
+        with self._lock:
+            while self._waiters:
+                granted = self._waiters.popleft()
+                if isinstance(granted, threading.Event):
+                    granted.set()
+                    return
+                try:
+                    granted.get_loop().call_soon_threadsafe(self._deliver, granted)
+                    return
+                except RuntimeError:
+                    # 等待者所在的事件循环已经关了，交给下一个
+                    continue
+            self._used -= 1
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+    async def __aenter__(self):
+        await self.aacquire()
+        return self
+
+    async def __aexit__(self, *exc):
+        self.release()
+
+
+_llm_slots = LLMSlots(LLM_MAX_CONCURRENCY)
+
+
+class LLMConcurrencyMiddleware(AgentMiddleware):
+    """
+    只限制模型调用本身；工具调用（等链上回执）不占名额
+    """
+
+    def wrap_model_call(self, request, handler):
+        with _llm_slots:
+            return handler(request)
+
+    async def awrap_model_call(self, request, handler):
+        async with _llm_slots:
+            return await handler(request)
+
+
+def build_agent(model, tools: list, checkpointer):
+    """
+    组装 agent；单独拎出来方便换成离线的假模型 / 假工具做压测
+    """
+    return create_agent(model, tools=tools,
+                        checkpointer=checkpointer,
+                        system_prompt=SYSTEM_PROMPT,
+                        # 按 token 预算裁剪历史、压缩旧的工具返回；限制 LLM 并发
+                        middleware=[ContextBudgetMiddleware(), LLMConcurrencyMiddleware()],
+                        )
+
+
+agent = build_agent(llm, [x402_relay_tool], checkpointer)
+
+# ==== 快速通道：用户直接贴 {"auth_main": ..., "auth_fee": ...} ====
+# 按 SYSTEM_PROMPT，这一步模型只是把 JSON 原样转给 x402_relay，
+# 没必要带着大段 system prompt + 全部历史再跑一轮 LLM（还可能把 JSON 抄错）。
+# 这里直接识别授权 JSON，从线程历史里找出上一次 x402_relay 调用的 user_address/to_address/amount，
+# 直接调工具；LLM 只用一个很短的 prompt 把工具结果说成人话。
+
+PHRASE_PROMPT = """
+你是 Web3 转账助手。下面是 x402_relay 工具（gasless USDC 转账）返回的 JSON。
+请用简洁的中文告诉用户结果：
+ - http_status = 200：转账成功，gas 由服务端代付，列出 relayTxMain 和 relayTxFee 两笔交易哈希
+ - 其他：说明错误原因（data.error 或返回内容），建议重新生成授权 / 检查金额 / 检查有效期
+不要编造不存在的交易哈希。
+"""
+
+# 快速通道的累计统计（次数 / 耗时 / 组织回复用掉的 token），方便和完整 agent 流程对比
+FAST_PATH_STATS = {
+    "hits": 0,
+    "relay_ms": 0.0,
+    "phrase_ms": 0.0,
+    "input_tokens": 0,
+    "output_tokens": 0,
+}
+
+# 完整 agent 流程的同口径统计（chat / achat 里每次 invoke 的耗时 + 这一轮所有模型调用的 token）；
+# auth_* 只统计用户贴授权 JSON 的那一轮，和快速通道正好可比
+AGENT_PATH_STATS = {
+    "runs": 0,
+    "ms": 0.0,
+    "input_tokens": 0,
+    "output_tokens": 0,
+    "auth_runs": 0,
+    "auth_ms": 0.0,
+    "auth_input_tokens": 0,
+    "auth_output_tokens": 0,
+}
+# chat / achat 可能在多个线程里同时跑，累加统计要加锁
+_stats_lock = threading.Lock()
+
+
+def parse_auth_payload(user_input: str) -> dict | None:
+    """
+    判断用户这句话是不是 {"auth_main": {...}, "auth_fee": {...}}（允许包在 ```json 代码块里）。
+    是则返回解析后的 dict，否则返回 None。
+    """
+    start = user_input.find("{")
+    end = user_input.rfind("}")
+    if start < 0 or end <= start:
+        return None
+    try:
+        payload = json.loads(user_input[start:end + 1])
+    except Exception:
+        return None
+    if not isinstance(payload, dict):
+        return None
+    if not isinstance(payload.get("auth_main"), dict) or not isinstance(payload.get("auth_fee"), dict):
+        return None
+    return {"auth_main": payload["auth_main"], "auth_fee": payload["auth_fee"]}
+
+
+def _quoted_lane(message: ToolMessage) -> dict:
+    """
+    x402_relay 返回的 402 报价里选中的 network / asset（精简 / 完整两种格式都认）
+    """
+    try:
+        result = json.loads(message.content)
+    except Exception:
+        return {}
+    if not isinstance(result, dict):
+        return {}
+    data = result.get("data")
+    if result.get("http_status") != 402 or not isinstance(data, dict):
+        return {}
+    if data.get("accepts"):
+        data = data["accepts"][0]
+    return {k: data[k] for k in ("network", "asset") if data.get(k)}
+
+
+def find_pending_transfer(messages: list) -> dict | None:
+    """
+    从线程历史里倒着找最近一次 x402_relay 调用，取出 user_address / to_address / amount，
+    以及那次调用返回的 402 里的 network / asset（用户就是按它签的名）。
+    """
+    lane = {}
+    for message in reversed(messages):
+        if isinstance(message, ToolMessage) and message.name == x402_relay_tool.name and not lane:
+            lane = _quoted_lane(message)
+        if not isinstance(message, AIMessage):
+            continue
+        for call in reversed(message.tool_calls or []):
+            if call.get("name") != x402_relay_tool.name:
+                continue
+            args = call.get("args", {}) or {}
+            if all(args.get(k) for k in ("user_address", "to_address", "amount")):
+                return {
+                    "user_address": args["user_address"],
+                    "to_address": args["to_address"],
+                    "amount": str(args["amount"]),
+                    **lane,
+                }
+    return None
+
+
+def _fast_path_messages(user_input: str, args: dict, tool_result: str) -> list:
+    """
+    构造和完整 agent 流程等价的一组消息（Human → AI(tool_call) → Tool），写回线程历史，
+    这样后续轮次的模型看到的上下文和走 LLM 时一致。
+    """
+    call_id = f"call_{uuid.uuid4().hex[:24]}"
+    return [
+        HumanMessage(content=user_input),
+        AIMessage(
+            content="",
+            tool_calls=[{"name": x402_relay_tool.name, "args": args, "id": call_id, "type": "tool_call"}],
+        ),
+        ToolMessage(content=tool_result, tool_call_id=call_id, name=x402_relay_tool.name),
+    ]
+
+
+def _prepare_fast_path(payload: dict, state) -> dict | None:
+    pending = find_pending_transfer(state.values.get("messages", []) if state else [])
+    if pending is None:
+        # 没有上下文（不知道给谁转、转多少）就交还给 LLM 处理
+        return None
+
+    # 重新序列化，保证传给工具的是规范 JSON
+    return {**pending, "payload_json": json.dumps(payload, ensure_ascii=False)}
+
+
+def _template_reply(tool_result: str) -> str:
+    """
+    组织回复的 LLM 调用失败时的兜底：直接按工具返回套模板（转账已经发生，不能因为措辞失败就报错）
+    """
+    try:
+        result = json.loads(tool_result)
+    except Exception:
+        result = None
+    if not isinstance(result, dict):
+        return f"转账请求已提交，工具返回：{tool_result}"
+
+    status = result.get("http_status")
+    data = result.get("data") if isinstance(result.get("data"), dict) else {}
+    if status == 200:
+        return (
+            "转账成功，gas 由服务端代付。\n"
+            f"本金交易哈希：{data.get('relayTxMain')}\n"
+            f"手续费交易哈希：{data.get('relayTxFee')}"
+        )
+    reason = data.get("error") or data.get("detail") or data.get("message") or result.get("data")
+    return f"转账未完成（HTTP {status}）：{reason}。请重新生成授权，或检查金额 / 有效期后再试。"
+
+
+def _record_fast_path(relay_ms: float, phrase_ms: float, phrased) -> None:
+    usage = getattr(phrased, "usage_metadata", None) or {}
+    with _stats_lock:
+        FAST_PATH_STATS["hits"] += 1
+        FAST_PATH_STATS["relay_ms"] += relay_ms
+        FAST_PATH_STATS["phrase_ms"] += phrase_ms
+        FAST_PATH_STATS["input_tokens"] += usage.get("input_tokens", 0)
+        FAST_PATH_STATS["output_tokens"] += usage.get("output_tokens", 0)
+    print(
+        f"[fast-path] relay {relay_ms:.0f}ms, phrase {phrase_ms:.0f}ms, "
+        f"tokens in/out {usage.get('input_tokens', 0)}/{usage.get('output_tokens', 0)}"
+    )
+
+
+def _turn_usage(messages: list) -> tuple[int, int]:
+    """
+    本轮（最后一条用户消息之后）所有 AI 消息的 token 用量
+    """
+    input_tokens = output_tokens = 0
+    for message in reversed(messages):
+        if isinstance(message, HumanMessage):
+            break
+        usage = getattr(message, "usage_metadata", None) or {}
+        input_tokens += usage.get("input_tokens", 0)
+        output_tokens += usage.get("output_tokens", 0)
+    return input_tokens, output_tokens
+
+
+def _record_agent_path(user_input: str, ms: float, messages: list) -> None:
+    input_tokens, output_tokens = _turn_usage(messages)
+    prefixes = [""]
+    if parse_auth_payload(user_input) is not None:
+        prefixes.append("auth_")
+    with _stats_lock:
+        for prefix in prefixes:
+            AGENT_PATH_STATS[f"{prefix}runs"] += 1
+            AGENT_PATH_STATS[f"{prefix}ms"] += ms
+            AGENT_PATH_STATS[f"{prefix}input_tokens"] += input_tokens
+            AGENT_PATH_STATS[f"{prefix}output_tokens"] += output_tokens
+
+
+def _avg(total: float, count: int) -> float | None:
+    return round(total / count, 2) if count else None
+
+
+def path_stats() -> dict:
+    """
+    快速通道 vs 完整 agent（提交授权那一轮）的平均耗时 / token，以及快速通道每次省下多少
+    """
+    fast_hits = FAST_PATH_STATS["hits"]
+    auth_runs = AGENT_PATH_STATS["auth_runs"]
+    fast = {
+        "hits": fast_hits,
+        "avg_ms": _avg(FAST_PATH_STATS["relay_ms"] + FAST_PATH_STATS["phrase_ms"], fast_hits),
+        "avg_input_tokens": _avg(FAST_PATH_STATS["input_tokens"], fast_hits),
+        "avg_output_tokens": _avg(FAST_PATH_STATS["output_tokens"], fast_hits),
+    }
+    full = {
+        "runs": auth_runs,
+        "avg_ms": _avg(AGENT_PATH_STATS["auth_ms"], auth_runs),
+        "avg_input_tokens": _avg(AGENT_PATH_STATS["auth_input_tokens"], auth_runs),
+        "avg_output_tokens": _avg(AGENT_PATH_STATS["auth_output_tokens"], auth_runs),
+    }
+    savings = None
+    if fast_hits and auth_runs:
+        savings = {
+            key: round(full[key] - fast[key], 2)
+            for key in ("avg_ms", "avg_input_tokens", "avg_output_tokens")
+        }
+    return {
+        "fast_path": fast,
+        "agent_auth_turns": full,
+        "agent_all_turns": {
+            "runs": AGENT_PATH_STATS["runs"],
+            "avg_ms": _avg(AGENT_PATH_STATS["ms"], AGENT_PATH_STATS["runs"]),
+        },
+        "savings_per_auth_turn": savings,
+    }
+
+
+def fast_path_relay(config: dict, user_input: str) -> dict | None:
+    """
+    命中快速通道时：直接调 x402_relay → 写回线程历史 → 用短 prompt 让 LLM 组织回复。
+    返回 {"args", "tool_result", "reply"}；不命中返回 None（调用方继续走完整 agent）。
+    """
+    # 先看是不是授权 JSON，普通聊天不必多读一次线程状态
+    payload = parse_auth_payload(user_input)
+    if payload is None:
+        return None
+    args = _prepare_fast_path(payload, agent.get_state(config))
+    if args is None:
+        return None
+
+    t0 = time.perf_counter()
+    tool_result = x402_relay_tool.invoke(args)
+    t1 = time.perf_counter()
+    # 转账已经发生：先把 Human → AI(tool_call) → Tool 落到历史里，组织回复失败也不丢这笔记录
+    agent.update_state(config, {"messages": _fast_path_messages(user_input, args, tool_result)}, as_node="tools")
+
+    phrased = None
+    try:
+        with _llm_slots:
+            phrased = llm.invoke([SystemMessage(content=PHRASE_PROMPT), HumanMessage(content=tool_result)])
+        reply = phrased.content if isinstance(phrased.content, str) else str(phrased.content)
+    except Exception as e:
+        print(f"[fast-path] phrase failed, using template reply: {e!r}")
+        reply = _template_reply(tool_result)
+    t2 = time.perf_counter()
+    _record_fast_path((t1 - t0) * 1000, (t2 - t1) * 1000, phrased)
+
+    agent.update_state(config, {"messages": [AIMessage(content=reply)]}, as_node="model")
+    return {"args": args, "tool_result": tool_result, "reply": reply}
+
+
+async def afast_path_relay(config: dict, user_input: str) -> dict | None:
+    """
+    fast_path_relay 的异步版本
+    """
+    payload = parse_auth_payload(user_input)
+    if payload is None:
+        return None
+    args = _prepare_fast_path(payload, await agent.aget_state(config))
+    if args is None:
+        return None
+
+    t0 = time.perf_counter()
+    tool_result = await x402_relay_tool.ainvoke(args)
+    t1 = time.perf_counter()
+    await agent.aupdate_state(
+        config, {"messages": _fast_path_messages(user_input, args, tool_result)}, as_node="tools"
+    )
+
+    phrased = None
+    try:
+        async with _llm_slots:
+            phrased = await llm.ainvoke([SystemMessage(content=PHRASE_PROMPT), HumanMessage(content=tool_result)])
+        reply = phrased.content if isinstance(phrased.content, str) else str(phrased.content)
+    except Exception as e:
+        print(f"[fast-path] phrase failed, using template reply: {e!r}")
+        reply = _template_reply(tool_result)
+    t2 = time.perf_counter()
+    _record_fast_path((t1 - t0) * 1000, (t2 - t1) * 1000, phrased)
+
+    await agent.aupdate_state(config, {"messages": [AIMessage(content=reply)]}, as_node="model")
+    return {"args": args, "tool_result": tool_result, "reply": reply}
 
-agent = create_agent(llm, tools=[x402_relay_tool],
-                     checkpointer=checkpointer,
-                     system_prompt=SYSTEM_PROMPT,
-                     )
 
 def chat_once(user_input: str):
 
@@ -160,15 +578,23 @@ def chat_once(user_input: str):
     })
     return result
 
-def chat(session_id: str, user_input: str) -> str:
+def chat(session_id: str, user_input: str, fast_path: bool = True) -> str:
     """
     session_id: 对话线程 id（比如用钱包地址、用户 id 等）
     user_input: 当前这一轮用户说的话
+    fast_path: False 时总是走完整 agent（用来和快速通道对比）
     返回：这一轮模型的自然语言回复
     """
     config = {"configurable": {"thread_id": session_id}}
 
+    # 第二步（用户贴授权 JSON）是纯机械操作，直接走快速通道
+    if fast_path:
+        fast = fast_path_relay(config, user_input)
+        if fast is not None:
+            return fast["reply"]
+
     # 直接用 invoke 拿“最终状态”
+    t0 = time.perf_counter()
     result = agent.invoke(
         {"messages": [("user", user_input)]},
         config=config,
@@ -176,7 +602,135 @@ def chat(session_id: str, user_input: str) -> str:
 
     # LangGraph state 里，messages 是完整对话（包含这轮）
     messages = result["messages"]
+    _record_agent_path(user_input, (time.perf_counter() - t0) * 1000, messages)
     last = messages[-1]
     # last 通常就是最后一条 assistant 消息
     return last.content if getattr(last, "content", None) else ""
 
+
+async def achat(session_id: str, user_input: str, fast_path: bool = True) -> str:
+    """
+    chat() 的异步版本（基于 agent.ainvoke），给并发的聊天服务用
+    """
+    config = {"configurable": {"thread_id": session_id}}
+
+    if fast_path:
+        fast = await afast_path_relay(config, user_input)
+        if fast is not None:
+            return fast["reply"]
+
+    t0 = time.perf_counter()
+    result = await agent.ainvoke(
+        {"messages": [("user", user_input)]},
+        config=config,
+    )
+    _record_agent_path(user_input, (time.perf_counter() - t0) * 1000, result["messages"])
+
+    last = result["messages"][-1]
+    return last.content if getattr(last, "content", None) else ""
+
+
+# ==== 流式输出 ====
+# stream_mode="messages" 逐 token 吐出模型输出；"updates" 在每个节点（model / tools）跑完时给出增量，
+# 用来告诉前端“正在调用工具 / 工具已返回”。
+STREAM_MODES = ["messages", "updates"]
+
+
+def _content_text(content) -> str:
+    """
+    AIMessageChunk.content 可能是 str，也可能是 [{"type": "text", "text": ...}, ...]，统一拍平成字符串
+    """
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        parts = []
+        for part in content:
+            if isinstance(part, str):
+                parts.append(part)
+            elif isinstance(part, dict) and part.get("type") == "text":
+                parts.append(part.get("text", ""))
+        return "".join(parts)
+    return ""
+
+
+def _to_events(mode: str, chunk):
+    """
+    把 LangGraph 的 (mode, chunk) 转成前端好用的事件：
+      {"type": "token",      "content": "..."}                       模型输出的一小段文本
+      {"type": "tool_start", "name": "x402_relay", "args": {...}}    模型决定调用工具
+      {"type": "tool_end",   "name": "x402_relay", "content": "..."} 工具返回
+    """
+    if mode == "messages":
+        message, metadata = chunk
+        # 只要模型节点的 token；tools 节点的 ToolMessage 走 updates 那条路
+        if metadata.get("langgraph_node") != "model":
+            return
+        text = _content_text(getattr(message, "content", ""))
+        if text:
+            yield {"type": "token", "content": text}
+        return
+
+    if mode == "updates":
+        for node, update in (chunk or {}).items():
+            if not isinstance(update, dict):
+                continue
+            for message in update.get("messages", []) or []:
+                if node == "model":
+                    for call in getattr(message, "tool_calls", None) or []:
+                        yield {"type": "tool_start", "name": call.get("name"), "args": call.get("args", {})}
+                elif node == "tools":
+                    yield {
+                        "type": "tool_end",
+                        "name": getattr(message, "name", None),
+                        "content": _content_text(getattr(message, "content", "")),
+                    }
+
+
+def _fast_path_events(fast: dict):
+    """
+    快速通道的结果按流式事件格式吐出，前端不用区分走的是哪条路
+    """
+    yield {"type": "tool_start", "name": x402_relay_tool.name, "args": fast["args"]}
+    yield {"type": "tool_end", "name": x402_relay_tool.name, "content": fast["tool_result"]}
+    yield {"type": "token", "content": fast["reply"]}
+
+
+def stream_chat(session_id: str, user_input: str):
+    """
+    chat() 的流式版本（同步生成器）：边生成边 yield 事件，而不是等整轮（含工具调用）结束才返回。
+    事件格式见 _to_events。
+    """
+    config = {"configurable": {"thread_id": session_id}}
+
+    fast = fast_path_relay(config, user_input)
+    if fast is not None:
+        yield from _fast_path_events(fast)
+        return
+
+    for mode, chunk in agent.stream(
+        {"messages": [("user", user_input)]},
+        config=config,
+        stream_mode=STREAM_MODES,
+    ):
+        yield from _to_events(mode, chunk)
+
+
+async def astream_chat(session_id: str, user_input: str):
+    """
+    chat() 的流式版本（异步生成器），给 FastAPI / asyncio 场景用。
+    """
+    config = {"configurable": {"thread_id": session_id}}
+
+    fast = await afast_path_relay(config, user_input)
+    if fast is not None:
+        for event in _fast_path_events(fast):
+            yield event
+        return
+
+    async for mode, chunk in agent.astream(
+        {"messages": [("user", user_input)]},
+        config=config,
+        stream_mode=STREAM_MODES,
+    ):
+        for event in _to_events(mode, chunk):
+            yield event
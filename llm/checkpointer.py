@@ -0,0 +1,302 @@
+# checkpointer.py
+import asyncio
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from langgraph.checkpoint.memory import MemorySaver
+
+# ==== 配置 ====
+# 常驻线程数上限（LRU），超过就淘汰最久没用的线程
+CHECKPOINT_MAX_THREADS = int(os.getenv("CHECKPOINT_MAX_THREADS", "1000"))
+# 空闲多久（秒）的线程被淘汰
+CHECKPOINT_TTL_SECONDS = int(os.getenv("CHECKPOINT_TTL_SECONDS", str(6 * 3600)))
+# 内存版：所有线程 checkpoint 序列化后的总字节数上限
+CHECKPOINT_MAX_BYTES = int(os.getenv("CHECKPOINT_MAX_BYTES", str(256 * 1024 * 1024)))
+# 配了就用本地 SQLite 持久化（多 worker 共享同一个文件即可共享线程；重启不丢历史）
+CHECKPOINT_SQLITE_PATH = os.getenv("CHECKPOINT_SQLITE_PATH", "")
+# SQLite 版多久扫一次过期线程
+CHECKPOINT_SWEEP_SECONDS = int(os.getenv("CHECKPOINT_SWEEP_SECONDS", "60"))
+
+
+def _sizeof(obj) -> int:
+    """
+    粗略估算 MemorySaver 里一条记录占多少字节：只数 bytes / str 的长度（序列化后的数据基本都是这两种）
+    """
+    if isinstance(obj, (bytes, bytearray, str)):
+        return len(obj)
+    if isinstance(obj, dict):
+        return sum(_sizeof(v) for v in obj.values())
+    if isinstance(obj, (tuple, list)):
+        return sum(_sizeof(v) for v in obj)
+    return 0
+
+
+class _LookupTimer:
+    """
+    记录 get_tuple 的次数和总耗时，用来看查找延迟
+    """
+
+    def __init__(self):
+        self.lookups = 0
+        self.lookup_seconds = 0.0
+
+    def observe(self, started: float):
+        self.lookups += 1
+        self.lookup_seconds += time.perf_counter() - started
+
+    def avg_ms(self) -> float:
+        return self.lookup_seconds / self.lookups * 1000 if self.lookups else 0.0
+
+
+class BoundedMemorySaver(MemorySaver):
+    """
+    带淘汰的 MemorySaver：
+    - LRU：常驻线程数超过 max_threads 时淘汰最久没访问的
+    - TTL：空闲超过 ttl_seconds 的线程被淘汰
+    - 内存上限：所有线程序列化后的总字节数超过 max_bytes 时继续按 LRU 淘汰
+    被淘汰的线程等同于新会话（历史清空）。
+    """
+
+    def __init__(
+        self,
+        max_threads: int = CHECKPOINT_MAX_THREADS,
+        ttl_seconds: int = CHECKPOINT_TTL_SECONDS,
+        max_bytes: int = CHECKPOINT_MAX_BYTES,
+        **kwargs,
+    ):
+        super().__init__(**kwargs)
+        self.max_threads = max_threads
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self._lock = threading.RLock()
+        # thread_id -> 最近访问时间，按访问顺序排列（最旧的在前）
+        self._last_access: OrderedDict[str, float] = OrderedDict()
+        # thread_id -> 估算字节数
+        self._thread_bytes: dict[str, int] = {}
+        self._total_bytes = 0
+        self._timer = _LookupTimer()
+
+    def _touch(self, thread_id: str):
+        with self._lock:
+            self._last_access[thread_id] = time.monotonic()
+            self._last_access.move_to_end(thread_id)
+
+    def _add_bytes(self, thread_id: str, n: int):
+        with self._lock:
+            self._thread_bytes[thread_id] = self._thread_bytes.get(thread_id, 0) + n
+            self._total_bytes += n
+
+    def _evict(self, keep: str | None = None):
+        with self._lock:
+            now = time.monotonic()
+            while self._last_access:
+                oldest, last = next(iter(self._last_access.items()))
+                if oldest == keep:
+                    break
+                expired = now - last > self.ttl_seconds
+                over_count = len(self._last_access) > self.max_threads
+                over_bytes = self._total_bytes > self.max_bytes
+                if not (expired or over_count or over_bytes):
+                    break
+                self.delete_thread(oldest)
+
+    def get_tuple(self, config):
+        started = time.perf_counter()
+        result = super().get_tuple(config)
+        self._timer.observe(started)
+
+        thread_id = config["configurable"]["thread_id"]
+        with self._lock:
+            expired = (
+                thread_id in self._last_access
+                and time.monotonic() - self._last_access[thread_id] > self.ttl_seconds
+            )
+        if expired:
+            self.delete_thread(thread_id)
+            return None
+        if result is not None:
+            self._touch(thread_id)
+        return result
+
+    def put(self, config, checkpoint, metadata, new_versions):
+        next_config = super().put(config, checkpoint, metadata, new_versions)
+
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        with self._lock:
+            n = _sizeof(self.storage[thread_id][checkpoint_ns].get(checkpoint["id"]))
+            n += sum(
+                _sizeof(self.blobs.get((thread_id, checkpoint_ns, k, v)))
+                for k, v in new_versions.items()
+            )
+        self._add_bytes(thread_id, n)
+        self._touch(thread_id)
+        self._evict(keep=thread_id)
+        return next_config
+
+    def put_writes(self, config, writes, task_id, task_path=""):
+        thread_id = config["configurable"]["thread_id"]
+        key = (
+            thread_id,
+            config["configurable"].get("checkpoint_ns", ""),
+            config["configurable"]["checkpoint_id"],
+        )
+        with self._lock:
+            before = _sizeof(self.writes.get(key))
+            super().put_writes(config, writes, task_id, task_path)
+            after = _sizeof(self.writes.get(key))
+        self._add_bytes(thread_id, after - before)
+        self._touch(thread_id)
+
+    def delete_thread(self, thread_id: str):
+        with self._lock:
+            super().delete_thread(thread_id)
+            self._last_access.pop(thread_id, None)
+            self._total_bytes -= self._thread_bytes.pop(thread_id, 0)
+
+    def stats(self) -> dict:
+        """
+        常驻线程数 / 总字节数 / 平均每线程字节数 / 平均查找耗时
+        """
+        with self._lock:
+            threads = len(self._last_access)
+            return {
+                "backend": "memory",
+                "threads": threads,
+                "total_bytes": self._total_bytes,
+                "bytes_per_thread": self._total_bytes // threads if threads else 0,
+                "lookups": self._timer.lookups,
+                "avg_lookup_ms": self._timer.avg_ms(),
+            }
+
+
+def _make_sqlite_saver(path: str, max_threads: int, ttl_seconds: int):
+    try:
+        from langgraph.checkpoint.sqlite import SqliteSaver
+    except ImportError as e:
+        raise RuntimeError(
+            "CHECKPOINT_SQLITE_PATH is set but langgraph-checkpoint-sqlite is not installed "
+            "(pip install langgraph-checkpoint-sqlite)"
+        ) from e
+
+    class BoundedSqliteSaver(SqliteSaver):
+        """
+        SQLite 持久化 + TTL / LRU 淘汰。
+        访问时间记在同一个库的 thread_access 表里，所以多个 worker 共享同一个文件时淘汰策略也一致。
+        历史都在磁盘上，进程内不常驻。
+        """
+
+        def __init__(self, conn: sqlite3.Connection):
+            super().__init__(conn)
+            self.max_threads = max_threads
+            self.ttl_seconds = ttl_seconds
+            self._last_sweep = 0.0
+            self._timer = _LookupTimer()
+            with self.lock, self.conn:
+                self.conn.execute(
+                    "CREATE TABLE IF NOT EXISTS thread_access "
+                    "(thread_id TEXT PRIMARY KEY, last_access REAL NOT NULL)"
+                )
+                self.conn.execute(
+                    "CREATE INDEX IF NOT EXISTS thread_access_last ON thread_access(last_access)"
+                )
+
+        def _touch(self, thread_id: str):
+            with self.lock, self.conn:
+                self.conn.execute(
+                    "INSERT INTO thread_access(thread_id, last_access) VALUES (?, ?) "
+                    "ON CONFLICT(thread_id) DO UPDATE SET last_access = excluded.last_access",
+                    (thread_id, time.time()),
+                )
+
+        def _sweep(self):
+            now = time.time()
+            if now - self._last_sweep < CHECKPOINT_SWEEP_SECONDS:
+                return
+            self._last_sweep = now
+            with self.lock:
+                expired = [
+                    row[0]
+                    for row in self.conn.execute(
+                        "SELECT thread_id FROM thread_access WHERE last_access < ?",
+                        (now - self.ttl_seconds,),
+                    )
+                ]
+                overflow = [
+                    row[0]
+                    for row in self.conn.execute(
+                        "SELECT thread_id FROM thread_access ORDER BY last_access DESC "
+                        "LIMIT -1 OFFSET ?",
+                        (self.max_threads,),
+                    )
+                ]
+            for thread_id in set(expired) | set(overflow):
+                self.delete_thread(thread_id)
+
+        def get_tuple(self, config):
+            started = time.perf_counter()
+            result = super().get_tuple(config)
+            self._timer.observe(started)
+            if result is not None:
+                self._touch(config["configurable"]["thread_id"])
+            return result
+
+        def put(self, config, checkpoint, metadata, new_versions):
+            next_config = super().put(config, checkpoint, metadata, new_versions)
+            self._touch(config["configurable"]["thread_id"])
+            self._sweep()
+            return next_config
+
+        def delete_thread(self, thread_id: str):
+            super().delete_thread(thread_id)
+            with self.lock, self.conn:
+                self.conn.execute("DELETE FROM thread_access WHERE thread_id = ?", (thread_id,))
+
+        # SqliteSaver 本身不支持 async 接口，这里放到线程池里跑同步版本，astream_chat 也能用
+        async def aget_tuple(self, config):
+            return await asyncio.to_thread(self.get_tuple, config)
+
+        async def alist(self, config, *, filter=None, before=None, limit=None):
+            items = await asyncio.to_thread(
+                lambda: list(self.list(config, filter=filter, before=before, limit=limit))
+            )
+            for item in items:
+                yield item
+
+        async def aput(self, config, checkpoint, metadata, new_versions):
+            return await asyncio.to_thread(self.put, config, checkpoint, metadata, new_versions)
+
+        async def aput_writes(self, config, writes, task_id, task_path=""):
+            return await asyncio.to_thread(self.put_writes, config, writes, task_id, task_path)
+
+        async def adelete_thread(self, thread_id: str):
+            return await asyncio.to_thread(self.delete_thread, thread_id)
+
+        def stats(self) -> dict:
+            with self.lock:
+                threads = self.conn.execute("SELECT COUNT(*) FROM thread_access").fetchone()[0]
+            return {
+                "backend": "sqlite",
+                "threads": threads,
+                "lookups": self._timer.lookups,
+                "avg_lookup_ms": self._timer.avg_ms(),
+            }
+
+    conn = sqlite3.connect(path, check_same_thread=False)
+    # WAL：多个 worker 同时读写同一个文件
+    conn.execute("PRAGMA journal_mode=WAL")
+    return BoundedSqliteSaver(conn)
+
+
+def make_checkpointer():
+    """
+    根据配置创建 checkpointer：
+    - 配了 CHECKPOINT_SQLITE_PATH → SQLite 持久化（带 TTL / LRU 淘汰）
+    - 否则 → 带 LRU / TTL / 内存上限的 BoundedMemorySaver
+    """
+    if CHECKPOINT_SQLITE_PATH:
+        return _make_sqlite_saver(CHECKPOINT_SQLITE_PATH, CHECKPOINT_MAX_THREADS, CHECKPOINT_TTL_SECONDS)
+    return BoundedMemorySaver()
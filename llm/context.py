@@ -0,0 +1,256 @@
+# context.py
+import json
+import os
+import threading
+from collections import OrderedDict, deque
+
+from langchain.agents.middleware import AgentMiddleware
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage, ToolMessage
+from langchain_core.messages.utils import count_tokens_approximately
+from langgraph.config import get_config
+
+from llm.llm_tools import compact_relay_result
+
+# ==== 配置 ====
+# 发给模型的历史消息 token 预算（不含 system prompt）
+CONTEXT_MAX_TOKENS = int(os.getenv("CONTEXT_MAX_TOKENS", "3000"))
+# 至少原样保留最近几轮（一轮 = 一条用户消息 + 之后的 AI / 工具消息）
+CONTEXT_KEEP_TURNS = int(os.getenv("CONTEXT_KEEP_TURNS", "2"))
+# 摘要里每条消息最多保留多少字符
+SUMMARY_SNIPPET_CHARS = 120
+# 较早对话摘要的 token 上限（算在 CONTEXT_MAX_TOKENS 之内），超出时只保留最新的几条
+CONTEXT_SUMMARY_MAX_TOKENS = int(os.getenv("CONTEXT_SUMMARY_MAX_TOKENS", "500"))
+# 按线程缓存摘要（增量追加，不必每次从头扫一遍被裁掉的历史），和 checkpointer 的常驻线程数一致
+SUMMARY_CACHE_MAX_THREADS = int(os.getenv("CHECKPOINT_MAX_THREADS", "1000"))
+
+# 最近若干轮的 token 统计，方便观察每轮输入 token 的变化
+CONTEXT_REPORTS = deque(maxlen=200)
+
+
+def _text(message) -> str:
+    content = getattr(message, "content", "")
+    return content if isinstance(content, str) else str(content)
+
+
+def _snippet(text: str) -> str:
+    text = " ".join(text.split())
+    if len(text) <= SUMMARY_SNIPPET_CHARS:
+        return text
+    return text[:SUMMARY_SNIPPET_CHARS] + "..."
+
+
+def tool_digest(message: ToolMessage) -> str:
+    """
+    旧的工具返回只保留结构化摘要（状态码 + 关键字段），去掉 402 的长描述和原始签名等。
+    """
+    try:
+        result = json.loads(_text(message))
+        data = result.get("data")
+        if result.get("http_status") == 402 and isinstance(data, dict) and "accepts" not in data:
+            # X402_TOOL_COMPACT=true 时工具返回的已经是精简格式，再压一次会把字段全变成 null
+            digest = {"http_status": 402, "data": data}
+        else:
+            digest = compact_relay_result(result.get("http_status", 0), data)
+    except Exception:
+        return _snippet(_text(message))
+    return json.dumps(digest, ensure_ascii=False)
+
+
+def _human_digest(message: HumanMessage) -> str:
+    text = _text(message)
+    # 授权 JSON（含签名）对后续对话没有用，只记一句
+    if '"auth_main"' in text and '"auth_fee"' in text:
+        return "[用户提交了 auth_main / auth_fee 授权 JSON]"
+    return _snippet(text)
+
+
+def _split_turns(messages: list) -> list[list]:
+    """
+    按用户消息切成若干轮，保证不会把 AI 的 tool_call 和对应的 ToolMessage 拆开。
+    """
+    turns = []
+    for message in messages:
+        if isinstance(message, HumanMessage) or not turns:
+            turns.append([message])
+        else:
+            turns[-1].append(message)
+    return turns
+
+
+def _digest_lines(message) -> list[str]:
+    if isinstance(message, HumanMessage):
+        return [f"用户: {_human_digest(message)}"]
+    if isinstance(message, ToolMessage):
+        return [f"工具 {message.name}: {tool_digest(message)}"]
+    lines = []
+    if isinstance(message, AIMessage):
+        for call in message.tool_calls or []:
+            args = {k: v for k, v in (call.get("args") or {}).items() if k != "payload_json"}
+            lines.append(f"助手调用 {call.get('name')}: {json.dumps(args, ensure_ascii=False)}")
+        if _text(message):
+            lines.append(f"助手: {_snippet(_text(message))}")
+    return lines
+
+
+def _line_tokens(line: str) -> int:
+    return count_tokens_approximately([line])
+
+
+SUMMARY_HEADER = "较早的对话摘要："
+SUMMARY_TRUNCATED = "（更早的对话已省略）"
+
+
+class _Summary:
+    """
+    一个线程被裁掉的那段历史（messages[:count]）的摘要：只留最新、放得进 CONTEXT_SUMMARY_MAX_TOKENS 的若干行
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.last_id = None
+        self.lines = deque()
+        self.tokens = 0
+        self.truncated = False
+
+    def extend(self, messages: list, max_tokens: int) -> None:
+        for message in messages:
+            for line in _digest_lines(message):
+                self.lines.append((line, _line_tokens(line)))
+                self.tokens += self.lines[-1][1]
+        # 标题行 / 省略提示也算在上限里
+        max_tokens -= _line_tokens(SUMMARY_HEADER + SUMMARY_TRUNCATED)
+        while self.lines and self.tokens > max_tokens:
+            self.tokens -= self.lines.popleft()[1]
+            self.truncated = True
+        if messages:
+            self.count += len(messages)
+            self.last_id = messages[-1].id
+
+    def matches(self, messages: list, count: int) -> bool:
+        # 缓存的前缀必须还是这段历史的前缀（线程历史只会往后追加；裁剪边界往回退时重建）
+        if not 0 < self.count <= count or self.last_id is None:
+            return False
+        return messages[self.count - 1].id == self.last_id
+
+    def render(self) -> str:
+        lines = [line for line, _ in self.lines]
+        if self.truncated:
+            lines.insert(0, SUMMARY_TRUNCATED)
+        return SUMMARY_HEADER + "\n" + "\n".join(lines)
+
+
+_summary_cache: OrderedDict = OrderedDict()
+_summary_lock = threading.Lock()
+
+
+def _summarize(messages: list, count: int, max_tokens: int, thread_id=None) -> str:
+    """
+    messages[:count] 是放不下、要压成摘要的那段历史。有 thread_id 时按线程缓存，只对新裁掉的消息做摘要。
+    """
+    if thread_id is None:
+        summary = _Summary()
+        summary.extend(messages[:count], max_tokens)
+        return summary.render()
+
+    with _summary_lock:
+        summary = _summary_cache.get(thread_id)
+        if summary is None or not summary.matches(messages, count):
+            summary = _Summary()
+        summary.extend(messages[summary.count:count], max_tokens)
+        _summary_cache[thread_id] = summary
+        _summary_cache.move_to_end(thread_id)
+        while len(_summary_cache) > SUMMARY_CACHE_MAX_THREADS:
+            _summary_cache.popitem(last=False)
+        return summary.render()
+
+
+def _compact_turn(turn: list) -> list:
+    """
+    非最新一轮里的工具消息换成摘要（保留 tool_call_id，消息结构仍然合法）
+    """
+    compacted = []
+    for message in turn:
+        if isinstance(message, ToolMessage):
+            message = ToolMessage(
+                content=tool_digest(message),
+                tool_call_id=message.tool_call_id,
+                name=message.name,
+            )
+        compacted.append(message)
+    return compacted
+
+
+def assemble_context(messages: list, max_tokens: int = CONTEXT_MAX_TOKENS, thread_id=None) -> list:
+    """
+    组装发给模型的上下文：
+    1) 最新一轮原样保留；更早的轮次里工具返回换成结构化摘要
+    2) 从最新往回保留整轮，直到超出 token 预算（至少保留 CONTEXT_KEEP_TURNS 轮）
+    3) 放不下的更早轮次压成一条摘要消息放在最前面；摘要最多 CONTEXT_SUMMARY_MAX_TOKENS，也算在预算里
+    只影响这次发给模型的内容，checkpointer 里的完整历史不变。
+    """
+    turns = _split_turns(messages)
+    if not turns:
+        return messages
+
+    kept = []
+    used = 0
+    for i in range(len(turns) - 1, -1, -1):
+        turn = turns[i] if i == len(turns) - 1 else _compact_turn(turns[i])
+        cost = count_tokens_approximately(turn)
+        if len(kept) >= CONTEXT_KEEP_TURNS and used + cost > max_tokens:
+            break
+        kept.insert(0, turn)
+        used += cost
+
+    if len(kept) == len(turns):
+        return [m for turn in kept for m in turn]
+
+    # 要加摘要：给它让出 CONTEXT_SUMMARY_MAX_TOKENS
+    summary_budget = min(CONTEXT_SUMMARY_MAX_TOKENS, max_tokens)
+    while len(kept) > CONTEXT_KEEP_TURNS and used > max_tokens - summary_budget:
+        used -= count_tokens_approximately(kept.pop(0))
+
+    dropped_count = sum(len(turn) for turn in turns[: len(turns) - len(kept)])
+    summary = _summarize(messages, dropped_count, summary_budget, thread_id)
+    return [SystemMessage(content=summary)] + [m for turn in kept for m in turn]
+
+
+def _thread_id():
+    try:
+        return get_config().get("configurable", {}).get("thread_id")
+    except RuntimeError:
+        # 不在 graph 里调用（没有 config）时不缓存
+        return None
+
+
+class ContextBudgetMiddleware(AgentMiddleware):
+    """
+    每次调用模型前按 token 预算重组上下文，并记录这一轮的 token 数（组装前 / 组装后）
+    """
+
+    def _assemble(self, request):
+        before = count_tokens_approximately(request.messages)
+        messages = assemble_context(request.messages, thread_id=_thread_id())
+        after = count_tokens_approximately(messages)
+        system = count_tokens_approximately([SystemMessage(content=request.system_prompt or "")])
+
+        report = {
+            "messages_before": len(request.messages),
+            "messages_after": len(messages),
+            "history_tokens_before": before,
+            "history_tokens_after": after,
+            "system_tokens": system,
+            "input_tokens": system + after,
+        }
+        CONTEXT_REPORTS.append(report)
+        print(
+            f"[context] messages {len(request.messages)}->{len(messages)}, "
+            f"history tokens ~{before}->{after}, total input ~{system + after}"
+        )
+        return request.override(messages=messages)
+
+    def wrap_model_call(self, request, handler):
+        return handler(self._assemble(request))
+
+    async def awrap_model_call(self, request, handler):
+        return await handler(self._assemble(request))
@@ -0,0 +1,245 @@
+# fakes.py
+# 离线用的假模型 / 假工具：不连 OpenAI、不连 /relay，用来压测 agent 本身和聊天服务
+import asyncio
+import hashlib
+import json
+import os
+import re
+import time
+from typing import Optional
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, HumanMessage, ToolMessage
+from langchain_core.messages.utils import count_tokens_approximately
+from langchain_core.outputs import ChatGeneration, ChatResult
+from langchain_core.tools import StructuredTool
+
+ADDRESS_RE = re.compile(r"0x[0-9a-fA-F]{40}\b")
+AMOUNT_RE = re.compile(r"(\d+(?:\.\d+)?)\s*USDC", re.IGNORECASE)
+
+
+def _parse_json(text: str):
+    try:
+        return json.loads(text)
+    except Exception:
+        return None
+
+
+def _pending_args(messages: list) -> Optional[dict]:
+    lane = {}
+    for message in reversed(messages):
+        if isinstance(message, ToolMessage) and not lane:
+            data = (_parse_json(message.content) or {}).get("data") or {}
+            lane = {k: data[k] for k in ("network", "asset") if isinstance(data, dict) and data.get(k)}
+        if isinstance(message, AIMessage):
+            for call in reversed(message.tool_calls or []):
+                args = call.get("args") or {}
+                if call.get("name") == "x402_relay" and args.get("user_address"):
+                    return {**{k: args[k] for k in ("user_address", "to_address", "amount")}, **lane}
+    return None
+
+
+def _describe_result(result: dict) -> str:
+    status = result.get("http_status")
+    data = result.get("data") or {}
+    if status == 200:
+        return f"转账成功：relayTxMain={data.get('relayTxMain')}，relayTxFee={data.get('relayTxFee')}"
+    if status == 402 and not data.get("error"):
+        return (
+            f"请生成两份 EIP-3009 授权：auth_main value={data.get('mainAmountAtomic')}，"
+            f"auth_fee value={data.get('feeAtomic')} 给 {data.get('serviceAddress')}"
+        )
+    return f"出错了：{data.get('error') or data}"
+
+
+class ScriptedChatModel(BaseChatModel):
+    """
+    按固定脚本回复的聊天模型，行为和 SYSTEM_PROMPT 约定的两步流程一致：
+    - 用户说“我的地址 0xA，给 0xB 转 0.1 USDC” → 调 x402_relay（不带 payload_json）
+    - 用户贴 {"auth_main": ..., "auth_fee": ...} → 调 x402_relay（带 payload_json）
+    - 收到工具返回 → 用一句话说明结果
+    latency_seconds 模拟模型接口耗时。
+    """
+
+    latency_seconds: float = 0.0
+
+    @property
+    def _llm_type(self) -> str:
+        return "scripted"
+
+    def bind_tools(self, tools, **kwargs):
+        return self
+
+    def _respond(self, messages: list) -> AIMessage:
+        last = messages[-1]
+        call_id = f"call_{len(messages)}"
+
+        if isinstance(last, ToolMessage):
+            result = _parse_json(last.content) or {}
+            return AIMessage(content=_describe_result(result))
+
+        text = last.content if isinstance(last.content, str) else str(last.content)
+        parsed = _parse_json(text)
+
+        # 快速通道里的“把工具结果说成人话”
+        if isinstance(parsed, dict) and "http_status" in parsed:
+            return AIMessage(content=_describe_result(parsed))
+
+        if isinstance(parsed, dict) and "auth_main" in parsed and "auth_fee" in parsed:
+            pending = _pending_args(messages)
+            if pending is not None:
+                args = {**pending, "payload_json": text}
+                return AIMessage(
+                    content="",
+                    tool_calls=[{"name": "x402_relay", "args": args, "id": call_id, "type": "tool_call"}],
+                )
+
+        addresses = ADDRESS_RE.findall(text)
+        amount = AMOUNT_RE.search(text)
+        if isinstance(last, HumanMessage) and len(addresses) >= 2 and amount:
+            args = {"user_address": addresses[0], "to_address": addresses[1], "amount": amount.group(1)}
+            return AIMessage(
+                content="",
+                tool_calls=[{"name": "x402_relay", "args": args, "id": call_id, "type": "tool_call"}],
+            )
+
+        return AIMessage(content="请告诉我你的地址、收款地址和转账金额。")
+
+    def _result(self, messages: list) -> ChatResult:
+        message = self._respond(messages)
+        input_tokens = count_tokens_approximately(messages)
+        output_tokens = count_tokens_approximately([message])
+        message.usage_metadata = {
+            "input_tokens": input_tokens,
+            "output_tokens": output_tokens,
+            "total_tokens": input_tokens + output_tokens,
+        }
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        if self.latency_seconds:
+            time.sleep(self.latency_seconds)
+        return self._result(messages)
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        if self.latency_seconds:
+            await asyncio.sleep(self.latency_seconds)
+        return self._result(messages)
+
+
+def fake_relay_result(
+    user_address: str,
+    to_address: str,
+    amount: str,
+    payload_json: Optional[str] = None,
+    network: Optional[str] = None,
+    asset: Optional[str] = None,
+) -> str:
+    """
+    和 x402_relay（精简输出）同样格式的固定返回：
+    - 没有 payload_json → 402 + 付款要求
+    - 有 payload_json → 200 + 由 payload 派生的确定性交易哈希
+    """
+    if not payload_json:
+        main_atomic = int(float(amount) * 10**6)
+        return json.dumps({
+            "http_status": 402,
+            "data": {
+                "network": "eip155:11155111",
+                "asset": "0x1c7D4B196Cb0C7B01d743Fbc6116a902379C7238",
+                "maxAmountRequired": str(main_atomic + 10_000),
+                "mainAmountAtomic": str(main_atomic),
+                "feeAtomic": "10000",
+                "serviceAddress": "0x" + "5e" * 20,
+            },
+        })
+
+    digest = hashlib.sha256(payload_json.encode("utf-8")).hexdigest()
+    return json.dumps({
+        "http_status": 200,
+        "data": {
+            "ok": True,
+            "relayTxMain": "0x" + digest,
+            "relayTxFee": "0x" + digest[::-1],
+        },
+    })
+
+
+def make_fake_relay_tool(latency_seconds: float = 0.0) -> StructuredTool:
+    """
+    名字 / 参数和真实 x402_relay 一致的本地假工具；latency_seconds 模拟网关 + 上链耗时
+    """
+
+    def relay(
+        user_address: str,
+        to_address: str,
+        amount: str,
+        payload_json: Optional[str] = None,
+        network: Optional[str] = None,
+        asset: Optional[str] = None,
+    ) -> str:
+        if latency_seconds:
+            time.sleep(latency_seconds)
+        return fake_relay_result(user_address, to_address, amount, payload_json, network, asset)
+
+    async def arelay(
+        user_address: str,
+        to_address: str,
+        amount: str,
+        payload_json: Optional[str] = None,
+        network: Optional[str] = None,
+        asset: Optional[str] = None,
+    ) -> str:
+        if latency_seconds:
+            await asyncio.sleep(latency_seconds)
+        return fake_relay_result(user_address, to_address, amount, payload_json, network, asset)
+
+    return StructuredTool.from_function(
+        func=relay,
+        coroutine=arelay,
+        name="x402_relay",
+        description="离线假 x402_relay：无 payload_json 返回 402，有则返回 200。",
+    )
+
+
+def install_offline_agent(llm_latency: float = 0.0, tool_latency: float = 0.0, checkpointer=None):
+    """
+    把 llm.agent 里的模型 / 工具 / agent 换成离线版本（chat / achat / stream_chat 等直接可用）。
+    没配 OPENAI_API_KEY 时先填一个假的，只是让 llm.agent 里的 ChatOpenAI 能构造，不会真的调用。
+    """
+    os.environ.setdefault("OPENAI_API_KEY", "sk-offline")
+    import llm.agent as agent_mod
+
+    model = ScriptedChatModel(latency_seconds=llm_latency)
+    tool = make_fake_relay_tool(latency_seconds=tool_latency)
+    if checkpointer is not None:
+        agent_mod.checkpointer = checkpointer
+    agent_mod.llm = model
+    agent_mod.x402_relay_tool = tool
+    agent_mod.agent = agent_mod.build_agent(model, [tool], agent_mod.checkpointer)
+    return agent_mod
+
+
+# ==== 压测脚本共用（bench_agent / bench_chat_api） ====
+
+def auth_payload_json(i: int) -> str:
+    """
+    第 i 个会话用户贴的授权 JSON（假签名，内容只要每个会话不同即可）
+    """
+    auth = {"from": f"0x{i:040x}", "to": "0x" + "b" * 40, "value": "100000", "nonce": f"0x{i:064x}"}
+    return json.dumps({"auth_main": auth, "auth_fee": {**auth, "value": "10000"}})
+
+
+def conversation_turns(i: int) -> list[str]:
+    """
+    第 i 个会话的“两步走”：先说要转账（拿到 402），再贴授权 JSON
+    """
+    return [
+        f"我的地址是 0x{i:040x}，帮我给 0x{'b' * 40} 转 0.1 USDC",
+        auth_payload_json(i),
+    ]
+
+
+def percentile(values: list, p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
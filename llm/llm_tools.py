@@ -1,47 +1,195 @@
 # llm_tools.py
 import os
+import asyncio
 import base64
 import json
+import threading
+import httpx
 import requests
+from requests.adapters import HTTPAdapter
+from contextlib import asynccontextmanager
 from typing import Optional
-from langchain.tools import tool
+from langchain_core.tools import StructuredTool
 
 X402_SERVER_URL = os.getenv("X402_SERVER_URL", "http://127.0.0.1:8000/relay")
 
+# ==== HTTP 连接池配置 ====
+X402_HTTP_TIMEOUT = float(os.getenv("X402_HTTP_TIMEOUT", "30"))
+X402_HTTP_MAX_CONNECTIONS = int(os.getenv("X402_HTTP_MAX_CONNECTIONS", "100"))
+X402_HTTP_MAX_KEEPALIVE = int(os.getenv("X402_HTTP_MAX_KEEPALIVE", "20"))
+# agent 和网关跑在同一个进程里时，直接通过 ASGI 调 app_x402.app，不走 loopback HTTP
+X402_INPROCESS = os.getenv("X402_INPROCESS", "false").lower() in ("1", "true", "yes")
+
 X402_VERSION = 1
 SCHEME = "eip3009-2auth"
-NETWORK = "eip155:11155111"
+# 调用方没传 network 时的默认结算链（网关只配了一条通道时就是它）
+NETWORK = os.getenv("X402_DEFAULT_NETWORK", "eip155:11155111")
+
+# 精简输出：只返回模型需要的字段（去掉 402 里的长 description / extra 原文等），省 token
+X402_TOOL_COMPACT = os.getenv("X402_TOOL_COMPACT", "true").lower() in ("1", "true", "yes")
+
+
+def compact_relay_result(http_status: int, data) -> dict:
+    """
+    把 /relay 的返回压缩成模型真正用得到的字段：
+    - 402：network / asset / mainAmountAtomic / feeAtomic / serviceAddress / error
+    - 200：relayTxMain / relayTxFee
+    - 其他：error / detail
+    """
+    if not isinstance(data, dict):
+        return {"http_status": http_status, "data": data}
+
+    compact = {}
+    if http_status == 402:
+        accepts = data.get("accepts") or [{}]
+        req = accepts[0] if isinstance(accepts[0], dict) else {}
+        extra = req.get("extra") or {}
+        compact = {
+            "network": req.get("network"),
+            "asset": req.get("asset"),
+            "maxAmountRequired": req.get("maxAmountRequired"),
+            "mainAmountAtomic": extra.get("mainAmountAtomic"),
+            "feeAtomic": extra.get("feeAtomic"),
+            "serviceAddress": extra.get("serviceAddress"),
+        }
+        if data.get("error"):
+            compact["error"] = data["error"]
+    elif http_status == 200:
+        compact = {
+            "ok": data.get("ok"),
+            "relayTxMain": data.get("relayTxMain"),
+            "relayTxFee": data.get("relayTxFee"),
+        }
+    else:
+        for key in ("error", "detail", "raw"):
+            if key in data:
+                compact[key] = data[key]
+
+    return {"http_status": http_status, "data": compact}
+
+TOOL_DESCRIPTION = """
+通过 x402 受保护的 /relay 接口，代用户在链上发起 gasless 代币转账（EIP-3009 两份授权）。
+
+使用方式（两步）：
+1）第一次调用：不要提供 payload_json。
+   - 工具会直接 POST /relay（没有 X-PAYMENT），收到 402 和 PaymentRequiredResponse。
+   - 你应该把里面的 network / asset / amount / fee / serviceAddress 解释给用户，
+     提醒 TA 使用自己的签名接口生成两份授权（auth_main / auth_fee），
+     然后只需把「包含 auth_main 和 auth_fee 的 JSON」发给你，例如：
+     {
+       "auth_main": { ... },
+       "auth_fee": { ... }
+     }
+
+2）第二次调用：当用户提供了 payload_json（只包含 auth_main/auth_fee）时，
+   - network / asset 传第一次调用返回的 402 里的 network / asset（用户签名时用的那条链和 token）
+   - 工具会在内部包装成完整的 X-PAYMENT JSON：
+     {
+       "x402Version": 1,
+       "scheme": "eip3009-2auth",
+       "network": <network>,
+       "asset": <asset>,
+       "payload": <payload_json 解析出来的 dict>
+     }
+   - 再 base64 编码后放入 X-PAYMENT 头，请求 /relay。
+"""
+
+# ==== 共享的连接池 ====
+# 同步版：requests.Session 复用 keep-alive 连接；异步版：每个事件循环一个 httpx.AsyncClient
+# （连接池绑在创建它的 loop 上，脚本里多次 asyncio.run / Streamlit 重跑时不能跨 loop 复用）
+_session: requests.Session | None = None
+_async_clients: dict[asyncio.AbstractEventLoop, httpx.AsyncClient] = {}
+_client_lock = threading.Lock()
+
+
+def get_session() -> requests.Session:
+    global _session
+    with _client_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=1,
+                pool_maxsize=X402_HTTP_MAX_KEEPALIVE,
+            )
+            _session.mount("http://", adapter)
+            _session.mount("https://", adapter)
+        return _session
+
 
-@tool("x402_relay")
-def x402_relay_tool(
+def get_async_client() -> httpx.AsyncClient:
+    """
+    当前事件循环的 httpx.AsyncClient（keep-alive + 连接数上限）。
+    X402_INPROCESS=true 时用 ASGITransport 直接调 app_x402.app，没有 socket。
+    注意 ASGITransport 不会跑 app_x402 的 lifespan（warm_up / 索引 / SIGTERM 排空），
+    需要调用方用 x402_inprocess_lifespan() 包住服务的生命周期（chat_api 已经这样做了）。
+    """
+    loop = asyncio.get_running_loop()
+    with _client_lock:
+        # 已关闭的 loop 上的 client 没法再 aclose，直接丢掉
+        for stale in [l for l in _async_clients if l.is_closed()]:
+            del _async_clients[stale]
+        client = _async_clients.get(loop)
+        if client is None:
+            limits = httpx.Limits(
+                max_connections=X402_HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=X402_HTTP_MAX_KEEPALIVE,
+            )
+            transport = None
+            if X402_INPROCESS:
+                # 延迟导入：只有同进程部署才需要加载网关（会连链、读私钥）
+                from app_x402 import app as x402_app
+                transport = httpx.ASGITransport(app=x402_app)
+            client = httpx.AsyncClient(
+                limits=limits,
+                timeout=X402_HTTP_TIMEOUT,
+                transport=transport,
+            )
+            _async_clients[loop] = client
+        return client
+
+
+@asynccontextmanager
+async def x402_inprocess_lifespan():
+    """
+    X402_INPROCESS=true 时在这里跑 app_x402 的 lifespan（ASGITransport 不会替我们跑）；否则什么都不做
+    """
+    if not X402_INPROCESS:
+        yield
+        return
+    from app_x402 import app as x402_app
+    async with x402_app.router.lifespan_context(x402_app):
+        yield
+
+
+async def aclose_clients():
+    """
+    进程退出时关闭连接池（异步 client 只关当前事件循环的那个）
+    """
+    global _session
+    with _client_lock:
+        client = _async_clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
+    if _session is not None:
+        _session.close()
+        _session = None
+
+
+def _error_result(http_status: int, **data) -> str:
+    return json.dumps({"http_status": http_status, "data": data}, ensure_ascii=False)
+
+
+def _build_request(
     user_address: str,
     to_address: str,
     amount: str,
-    payload_json: Optional[str] = None,
-) -> str:
+    payload_json: Optional[str],
+    network: Optional[str] = None,
+    asset: Optional[str] = None,
+) -> tuple[dict, dict]:
     """
-    通过 x402 受保护的 /relay 接口，代用户在链上发起 gasless 代币转账（EIP-3009 两份授权）。
-
-    使用方式（两步）：
-    1）第一次调用：不要提供 payload_json。
-       - 工具会直接 POST /relay（没有 X-PAYMENT），收到 402 和 PaymentRequiredResponse。
-       - 你应该把里面的 network / asset / amount / fee / serviceAddress 解释给用户，
-         提醒 TA 使用自己的签名接口生成两份授权（auth_main / auth_fee），
-         然后只需把「包含 auth_main 和 auth_fee 的 JSON」发给你，例如：
-         {
-           "auth_main": { ... },
-           "auth_fee": { ... }
-         }
-
-    2）第二次调用：当用户提供了 payload_json（只包含 auth_main/auth_fee）时，
-       - 工具会在内部包装成完整的 X-PAYMENT JSON：
-         {
-           "x402Version": 1,
-           "scheme": "eip3009-2auth",
-           "network": "eip155:11155111",
-           "payload": <payload_json 解析出来的 dict>
-         }
-       - 再 base64 编码后放入 X-PAYMENT 头，请求 /relay。
+    构造 /relay 的 body 和 headers；payload_json 不是合法 JSON 时抛 ValueError。
+    network / asset 取自 402 里选中的那一项 accepts；同一条链上配了多个 token 时网关必须拿到 asset
     """
     body = {
         "user_address": user_address,
@@ -55,58 +203,96 @@ def x402_relay_tool(
         try:
             inner = json.loads(payload_json)  # 这里预期是 {"auth_main": {...}, "auth_fee": {...}}
         except Exception as e:
-            return json.dumps(
-                {
-                    "http_status": 0,
-                    "data": {
-                        "error": f"payload_json 不是合法 JSON: {e}",
-                        "raw": payload_json,
-                    },
-                },
-                ensure_ascii=False,
-            )
+            raise ValueError(f"payload_json 不是合法 JSON: {e}")
+
+        # 用户贴的 JSON 里如果带了 network / asset，也认（但不放进 payload）
+        if isinstance(inner, dict):
+            network = network or inner.pop("network", None)
+            asset = asset or inner.pop("asset", None)
 
         full_payload = {
             "x402Version": X402_VERSION,
             "scheme": SCHEME,
-            "network": NETWORK,
+            "network": network or NETWORK,
             "payload": inner,
         }
+        if asset:
+            full_payload["asset"] = asset
         json_str = json.dumps(full_payload)
         b64 = base64.b64encode(json_str.encode("utf-8")).decode("ascii")
         headers["X-PAYMENT"] = b64
 
-    try:
-        resp = requests.post(X402_SERVER_URL, json=body, headers=headers, timeout=30)
-    except Exception as e:
-        return json.dumps(
-            {
-                "http_status": 0,
-                "data": {
-                    "error": f"Request to x402 server failed: {e}",
-                },
-            },
-            ensure_ascii=False,
-        )
+    return body, headers
+
 
+def _format_response(status_code: int, resp) -> str:
     try:
         data = resp.json()
     except Exception:
-        return json.dumps(
-            {
-                "http_status": resp.status_code,
-                "data": {
-                    "error": "Non-JSON response from x402 server",
-                    "raw": resp.text,
-                },
-            },
-            ensure_ascii=False,
+        return _error_result(
+            status_code,
+            error="Non-JSON response from x402 server",
+            raw=resp.text,
         )
 
+    if X402_TOOL_COMPACT:
+        return json.dumps(compact_relay_result(status_code, data), ensure_ascii=False)
+
     return json.dumps(
         {
-            "http_status": resp.status_code,
+            "http_status": status_code,
             "data": data,
         },
         ensure_ascii=False,
-    )
\ No newline at end of file
+    )
+
+
+def x402_relay(
+    user_address: str,
+    to_address: str,
+    amount: str,
+    payload_json: Optional[str] = None,
+    network: Optional[str] = None,
+    asset: Optional[str] = None,
+) -> str:
+    try:
+        body, headers = _build_request(user_address, to_address, amount, payload_json, network, asset)
+    except ValueError as e:
+        return _error_result(0, error=str(e), raw=payload_json)
+
+    try:
+        resp = get_session().post(X402_SERVER_URL, json=body, headers=headers, timeout=X402_HTTP_TIMEOUT)
+    except Exception as e:
+        return _error_result(0, error=f"Request to x402 server failed: {e}")
+
+    return _format_response(resp.status_code, resp)
+
+
+async def ax402_relay(
+    user_address: str,
+    to_address: str,
+    amount: str,
+    payload_json: Optional[str] = None,
+    network: Optional[str] = None,
+    asset: Optional[str] = None,
+) -> str:
+    try:
+        body, headers = _build_request(user_address, to_address, amount, payload_json, network, asset)
+    except ValueError as e:
+        return _error_result(0, error=str(e), raw=payload_json)
+
+    try:
+        resp = await get_async_client().post(X402_SERVER_URL, json=body, headers=headers)
+    except Exception as e:
+        return _error_result(0, error=f"Request to x402 server failed: {e}")
+
+    return _format_response(resp.status_code, resp)
+
+
+# 同一个工具同时提供同步 / 异步实现：agent.invoke 走 x402_relay，agent.ainvoke / astream 走 ax402_relay
+x402_relay_tool = StructuredTool.from_function(
+    func=x402_relay,
+    coroutine=ax402_relay,
+    name="x402_relay",
+    description=TOOL_DESCRIPTION,
+)
@@ -0,0 +1,240 @@
+# rpc_provider.py
+# 多 RPC 节点的 web3 provider：
+# - 每个节点记录延迟 / 错误率的 EWMA，读请求发给最快的健康节点
+# - 读请求超过该节点 p95 延迟还没回来，就对冲（hedge）发给第二个节点，谁先回来用谁
+# - 节点报错（连接失败 / 超时 / 限流）自动切到下一个
+# - eth_sendRawTransaction 同时发给所有节点，加快广播
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+
+from web3 import Web3
+from web3.providers.base import BaseProvider
+
+RPC_TIMEOUT = float(os.getenv("RPC_TIMEOUT", "10"))
+# EWMA 平滑系数
+RPC_EWMA_ALPHA = float(os.getenv("RPC_EWMA_ALPHA", "0.2"))
+# 错误率 EWMA 超过这个值视为不健康
+RPC_UNHEALTHY_ERROR_RATE = float(os.getenv("RPC_UNHEALTHY_ERROR_RATE", "0.5"))
+# 连续失败后暂停使用多久（秒）
+RPC_COOLDOWN_SECONDS = float(os.getenv("RPC_COOLDOWN_SECONDS", "30"))
+# 错误率 EWMA 的半衰期（秒）：不健康的节点没有请求也会随时间恢复，不会被永久排除
+RPC_ERROR_HALF_LIFE_SECONDS = float(os.getenv("RPC_ERROR_HALF_LIFE_SECONDS", "30"))
+# 样本不够时的对冲等待时间（秒）
+RPC_HEDGE_MIN_DELAY = float(os.getenv("RPC_HEDGE_MIN_DELAY", "0.05"))
+
+# 只有这一个方法是“写”，其余都当读处理（可重试、可对冲）
+SEND_RAW_TX = "eth_sendRawTransaction"
+# 节点返回的这些 JSON-RPC 错误当作节点故障（限流等），换节点重试；其余错误（如 revert）原样返回
+RATE_LIMIT_CODES = {-32005, 429}
+
+
+def _is_node_failure(response) -> bool:
+    if not isinstance(response, dict) or "error" not in response:
+        return False
+    error = response["error"]
+    if not isinstance(error, dict):
+        return False
+    message = str(error.get("message", "")).lower()
+    return error.get("code") in RATE_LIMIT_CODES or "rate limit" in message or "too many requests" in message
+
+
+class NodeFailure(Exception):
+    def __init__(self, response):
+        super().__init__(str(response.get("error")))
+        self.response = response
+
+
+class Endpoint:
+    """
+    单个节点 + 它的统计
+    """
+
+    def __init__(self, url: str):
+        self.url = url
+        # 关掉 web3 自带的重试（默认 5 次 + 退避）：故障切换由本层负责，失败要立刻反映到统计里
+        self.provider = Web3.HTTPProvider(
+            url, request_kwargs={"timeout": RPC_TIMEOUT}, exception_retry_configuration=None,
+        )
+        self.latency_ewma: float | None = None
+        self.error_ewma = 0.0
+        self.error_updated = time.monotonic()
+        self.samples: deque = deque(maxlen=200)
+        self.consecutive_failures = 0
+        self.cooldown_until = 0.0
+        self.lock = threading.Lock()
+
+    def _decayed_error(self, now: float) -> float:
+        return self.error_ewma * 0.5 ** ((now - self.error_updated) / RPC_ERROR_HALF_LIFE_SECONDS)
+
+    def _update_error(self, sample: float):
+        now = time.monotonic()
+        self.error_ewma = RPC_EWMA_ALPHA * sample + (1 - RPC_EWMA_ALPHA) * self._decayed_error(now)
+        self.error_updated = now
+
+    def record_success(self, latency: float | None):
+        """
+        latency=None：只记成功、不计入延迟样本（广播交易的耗时和读请求不是一回事，不能拿来算对冲等待）
+        """
+        with self.lock:
+            if latency is not None:
+                self.samples.append(latency)
+                if self.latency_ewma is None:
+                    self.latency_ewma = latency
+                else:
+                    self.latency_ewma = RPC_EWMA_ALPHA * latency + (1 - RPC_EWMA_ALPHA) * self.latency_ewma
+            self._update_error(0.0)
+            self.consecutive_failures = 0
+
+    def record_failure(self):
+        with self.lock:
+            self._update_error(1.0)
+            self.consecutive_failures += 1
+            if self.consecutive_failures >= 3:
+                self.cooldown_until = time.monotonic() + RPC_COOLDOWN_SECONDS
+
+    def error_rate(self) -> float:
+        with self.lock:
+            return self._decayed_error(time.monotonic())
+
+    def healthy(self) -> bool:
+        return self.error_rate() < RPC_UNHEALTHY_ERROR_RATE and time.monotonic() >= self.cooldown_until
+
+    def p95(self) -> float:
+        with self.lock:
+            if len(self.samples) < 20:
+                return RPC_HEDGE_MIN_DELAY
+            ordered = sorted(self.samples)
+        return max(RPC_HEDGE_MIN_DELAY, ordered[int(len(ordered) * 0.95)])
+
+    def stats(self) -> dict:
+        return {
+            "url": self.url,
+            "healthy": self.healthy(),
+            "latency_ewma_ms": round(self.latency_ewma * 1000, 1) if self.latency_ewma is not None else None,
+            "error_rate_ewma": round(self.error_rate(), 3),
+            "p95_ms": round(self.p95() * 1000, 1),
+        }
+
+
+class MultiEndpointProvider(BaseProvider):
+    """
+    把多个 HTTPProvider 包成一个 provider，web3 上层代码不用改
+    """
+
+    def __init__(self, urls: list[str]):
+        super().__init__()
+        if not urls:
+            raise RuntimeError("MultiEndpointProvider needs at least one RPC url")
+        self.endpoints = [Endpoint(url) for url in urls]
+        self._pool = ThreadPoolExecutor(max_workers=max(4, len(urls) * 4), thread_name_prefix="rpc")
+
+    def ranked(self) -> list[Endpoint]:
+        """
+        健康的在前，按延迟 EWMA 从小到大；还没有样本的节点排在最前，先探一下
+        """
+        def key(ep: Endpoint):
+            latency = ep.latency_ewma if ep.latency_ewma is not None else 0.0
+            return (not ep.healthy(), latency)
+        return sorted(self.endpoints, key=key)
+
+    @staticmethod
+    def _timed(ep: Endpoint, fn, record_latency: bool = True):
+        t0 = time.perf_counter()
+        try:
+            response = fn(ep.provider)
+        except Exception:
+            ep.record_failure()
+            raise
+        if _is_node_failure(response):
+            ep.record_failure()
+            raise NodeFailure(response)
+        ep.record_success(time.perf_counter() - t0 if record_latency else None)
+        return response
+
+    def _read(self, fn):
+        """
+        发给排名第一的节点；超过它的 p95 还没回来就对冲到下一个；失败就立刻换下一个
+        """
+        untried = self.ranked()
+        pending = set()
+        errors = []
+        hedge_delay = untried[0].p95()
+
+        def launch():
+            ep = untried.pop(0)
+            pending.add(self._pool.submit(self._timed, ep, fn))
+
+        launch()
+        while pending:
+            timeout = hedge_delay if untried else None
+            done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                # 对冲：慢请求不取消，谁先回来用谁
+                launch()
+                continue
+            for future in done:
+                try:
+                    return future.result()
+                except Exception as e:
+                    errors.append(e)
+            if not pending and untried:
+                launch()
+
+        last = errors[-1]
+        if isinstance(last, NodeFailure):
+            return last.response
+        raise last
+
+    def _broadcast(self, fn):
+        """
+        同时发给所有节点，第一个成功的结果返回；全部失败时返回 / 抛出最后一个错误
+        """
+        futures = [self._pool.submit(self._timed, ep, fn, False) for ep in self.endpoints]
+        first_error_response = None
+        last_error = None
+        for future in as_completed(futures):
+            try:
+                response = future.result()
+            except NodeFailure as e:
+                last_error = e
+                continue
+            except Exception as e:
+                last_error = e
+                continue
+            if "error" not in response:
+                return response
+            # 节点拒绝（比如 already known / nonce too low），先记下，看别的节点是否成功
+            first_error_response = first_error_response or response
+        if first_error_response is not None:
+            return first_error_response
+        if isinstance(last_error, NodeFailure):
+            return last_error.response
+        raise last_error
+
+    def make_request(self, method, params):
+        fn = lambda provider: provider.make_request(method, params)
+        if method == SEND_RAW_TX:
+            return self._broadcast(fn)
+        return self._read(fn)
+
+    def make_batch_request(self, batch_requests):
+        return self._read(lambda provider: provider.make_batch_request(batch_requests))
+
+    def is_connected(self, show_traceback: bool = False) -> bool:
+        return any(ep.provider.is_connected(show_traceback) for ep in self.ranked())
+
+    def stats(self) -> list[dict]:
+        return [ep.stats() for ep in self.endpoints]
+
+
+def make_provider(rpc_urls: str):
+    """
+    RPC 地址用逗号分隔可以配多个；只有一个就用普通 HTTPProvider
+    """
+    urls = [u.strip() for u in rpc_urls.split(",") if u.strip()]
+    if len(urls) == 1:
+        return Web3.HTTPProvider(urls[0], request_kwargs={"timeout": RPC_TIMEOUT})
+    return MultiEndpointProvider(urls)
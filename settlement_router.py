@@ -0,0 +1,415 @@
+# settlement_router.py
+# 多链 / 多 token 结算路由：每个 (CAIP-2 network, asset) 一条“通道”（lane），
+# 各自有独立的 RPC 连接池、缓存的 token 元数据、relayer nonce 计数和结算线程池，
+# 某条链慢了只会堵它自己的通道，不影响其他链的结算。
+import asyncio
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+from web3 import Web3
+from web3.exceptions import TimeExhausted, TransactionNotFound
+
+from rpc_provider import make_provider
+from sign.eip3009_abi import EIP3009_ABI
+from sign.eip3009_meta import RelayerNonce, authorization_args, relayer_account, send_with_relayer_nonce
+
+# 结算通道配置：X402_ROUTES（JSON 字符串）或 X402_ROUTES_FILE（JSON 文件），格式：
+# [{"network": "eip155:11155111", "chainId": 11155111, "rpcUrl": "https://...", "asset": "0x...",
+#   "name": "USD Coin", "version": "2", "decimals": 6, "maxWorkers": 8}, ...]
+# 都没配时用 properties.env 里单链的 RPC_URL_SEPOLIA / TOKEN_ADDRESS / CHAIN_ID。
+X402_ROUTES = os.getenv("X402_ROUTES", "")
+X402_ROUTES_FILE = os.getenv("X402_ROUTES_FILE", "")
+LANE_MAX_WORKERS = int(os.getenv("LANE_MAX_WORKERS", "8"))
+RECEIPT_TIMEOUT_SECONDS = int(os.getenv("RECEIPT_TIMEOUT_SECONDS", "120"))
+RECEIPT_POLL_SECONDS = float(os.getenv("RECEIPT_POLL_SECONDS", "1"))
+# 排空（drain）到期后不再等回执，但还没广播的那一笔照样广播；最多再给这么多秒把广播做完
+DRAIN_BROADCAST_GRACE_SECONDS = float(os.getenv("DRAIN_BROADCAST_GRACE_SECONDS", "15"))
+# 排空时回执没确认 / 没走完的结算追加写到这里（NDJSON），之后用 batch_relay.py --resume-pending 核对补完
+PENDING_SETTLEMENTS_FILE = os.getenv("PENDING_SETTLEMENTS_FILE", "pending_settlements.ndjson")
+
+
+class Settlement:
+    """
+    一笔在途结算（auth_main + auth_fee），记录走到了哪一步：
+    admitted → main_sent → main_confirmed → fee_sent → fee_confirmed
+    排空时没等回执就继续往下走的那一笔记在 unconfirmed 里
+    """
+
+    def __init__(self, lane: "SettlementLane", auth_main: dict, auth_fee: dict):
+        self.lane = lane
+        self.auth_main = auth_main
+        self.auth_fee = auth_fee
+        self.stage = "admitted"
+        self.tx_main: str | None = None
+        self.tx_fee: str | None = None
+        self.unconfirmed: list[str] = []
+        self.recorded = False
+        # “是否已被排空记录”的检查 + 广播放在这把锁里；router._record 记录前也要拿它，
+        # 所以记录要么发生在广播前（之后不再发），要么等广播完、带着交易哈希
+        self.lock = threading.Lock()
+
+    def to_record(self) -> dict:
+        return {
+            "recordedAt": int(time.time()),
+            "network": self.lane.network,
+            "asset": self.lane.asset,
+            "stage": self.stage,
+            "tx_main": self.tx_main,
+            "tx_fee": self.tx_fee,
+            "unconfirmed": self.unconfirmed,
+            "auth_main": self.auth_main,
+            "auth_fee": self.auth_fee,
+        }
+
+
+class SettlementHandedOff(Exception):
+    """
+    排空到期：这笔结算没等到回执（两笔都已广播），或者已经按当前进度写进记录、不能再广播
+    """
+
+    def __init__(self, settlement: Settlement):
+        super().__init__(f"settlement handed off at stage {settlement.stage}")
+        self.settlement = settlement
+
+
+class SettlementLane:
+    """
+    一条结算通道：一条链上的一个 EIP-3009 token
+    """
+
+    def __init__(
+        self,
+        network: str,
+        chain_id: int,
+        rpc_url: str,
+        asset: str,
+        name: str,
+        version: str,
+        decimals: int | None = None,
+        max_workers: int = LANE_MAX_WORKERS,
+        nonces: RelayerNonce | None = None,
+    ):
+        self.network = network
+        self.chain_id = chain_id
+        self.asset = Web3.to_checksum_address(asset)
+        self.name = name
+        self.version = version
+        self.w3 = Web3(make_provider(rpc_url))
+        self.token = self.w3.eth.contract(address=self.asset, abi=EIP3009_ABI)
+        self._decimals = decimals
+        # relayer 在这条链上的 nonce（和 sign.eip3009_meta 共用同一套分配 / 重新同步逻辑）；
+        # 同一条链上的多个 token 通道必须共用一个（router 按 chain_id 传进来），否则会分出重复的 nonce
+        self.nonces = nonces or RelayerNonce(self.w3, relayer_account.address)
+        self._lock = threading.Lock()
+        # 排空到期后置位：在途的回执等待立刻放弃（还没广播的那一笔仍然广播出去）
+        self._abandon = threading.Event()
+        # 每条通道自己的线程池：广播 + 等回执都在这里跑
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f"lane-{chain_id}")
+
+    @property
+    def key(self) -> tuple[str, str]:
+        return self.network, self.asset.lower()
+
+    # ---- token 元数据（只查一次） ----
+    @property
+    def decimals(self) -> int:
+        if self._decimals is None:
+            with self._lock:
+                if self._decimals is None:
+                    self._decimals = self.token.functions.decimals().call()
+        return self._decimals
+
+    def human_to_atomic(self, human: str | Decimal) -> int:
+        if not isinstance(human, Decimal):
+            human = Decimal(str(human))
+        return int(human * (Decimal(10) ** self.decimals))
+
+    # ---- 结算 ----
+    def _wait_for_receipt(self, tx_hash):
+        """
+        轮询回执；和 wait_for_transaction_receipt 一样有超时。排空到期后不再等，返回 None
+        """
+        deadline = time.monotonic() + RECEIPT_TIMEOUT_SECONDS
+        while True:
+            try:
+                return self.w3.eth.get_transaction_receipt(tx_hash)
+            except TransactionNotFound:
+                pass
+            if time.monotonic() >= deadline:
+                raise TimeExhausted(
+                    f"Transaction {tx_hash.hex()} is not in the chain after {RECEIPT_TIMEOUT_SECONDS} seconds"
+                )
+            if self._abandon.wait(RECEIPT_POLL_SECONDS):
+                return None
+
+    def relay_with_authorization(self, auth: dict, settlement: Settlement | None = None, leg: str = "main") -> str:
+        settlement = settlement or Settlement(self, auth, {})
+
+        # nonce 在广播前才分配（build_transaction 失败不会占用 nonce）
+        tx = self.token.functions.transferWithAuthorization(
+            *authorization_args(auth)
+        ).build_transaction(
+            {
+                "from": relayer_account.address,
+                "nonce": 0,
+                "chainId": self.chain_id,
+                "gas": 200_000,
+                "maxFeePerGas": self.w3.to_wei("2", "gwei"),
+                "maxPriorityFeePerGas": self.w3.to_wei("1", "gwei"),
+            }
+        )
+
+        with settlement.lock:
+            if settlement.recorded:
+                # 排空已经按“这一笔没广播”记录下来了，交给补结算处理，这里不能再发
+                raise SettlementHandedOff(settlement)
+            previous_stage = settlement.stage
+            settlement.stage = f"{leg}_sending"
+            try:
+                tx_hash = send_with_relayer_nonce(self.w3, self.nonces, tx)
+            except Exception:
+                settlement.stage = previous_stage
+                raise
+            setattr(settlement, f"tx_{leg}", tx_hash.hex())
+            settlement.stage = f"{leg}_sent"
+        print(f"[{self.network}] Sent meta-tx:", tx_hash.hex())
+        receipt = self._wait_for_receipt(tx_hash)
+        if receipt is None:
+            print(f"[{self.network}] Draining, not waiting for receipt of", tx_hash.hex())
+            settlement.unconfirmed.append(leg)
+            return tx_hash.hex()
+        print(f"[{self.network}] Status:", receipt.status)
+        if receipt.status != 1:
+            raise RuntimeError("Meta-tx failed")
+        settlement.stage = f"{leg}_confirmed"
+        return tx_hash.hex()
+
+    def relay_two_auth(self, auth_main: dict, auth_fee: dict, settlement: Settlement | None = None) -> dict:
+        settlement = settlement or Settlement(self, auth_main, auth_fee)
+        tx_main = self.relay_with_authorization(auth_main, settlement, "main")
+        tx_fee = self.relay_with_authorization(auth_fee, settlement, "fee")
+        if settlement.unconfirmed:
+            raise SettlementHandedOff(settlement)
+        return {"tx_main": tx_main, "tx_fee": tx_fee}
+
+    async def run(self, fn, *args):
+        """
+        在本通道的线程池里跑阻塞调用
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, fn, *args)
+
+    def payment_requirement(
+        self,
+        scheme: str,
+        resource_url: str,
+        main_amount_atomic: int,
+        fee_amount_atomic: int,
+        max_timeout_seconds: int,
+    ) -> dict:
+        """
+        402 响应 accepts 里的一项
+        """
+        return {
+            "scheme": scheme,
+            "network": self.network,
+            # 这里 maxAmountRequired 可以理解为：需要从 A 地址扣掉的总 token 数量
+            "maxAmountRequired": str(main_amount_atomic + fee_amount_atomic),
+            "resource": resource_url,
+            "description": (
+                "Provide two EIP-3009 authorizations: "
+                "main(A->to_address, amount) and fee(A->service, BASE_FEE). "
+                "Relayer pays gas and broadcasts meta-txs."
+            ),
+            "mimeType": "application/json",
+            # payTo 可以理解为服务费的接收方
+            "payTo": relayer_account.address,
+            "maxTimeoutSeconds": max_timeout_seconds,
+            "asset": self.asset,
+            "extra": {
+                "name": self.name,
+                "version": self.version,
+                "chainId": self.chain_id,
+                "mainAmountAtomic": str(main_amount_atomic),
+                "feeAtomic": str(fee_amount_atomic),
+                "serviceAddress": relayer_account.address,
+            },
+        }
+
+
+def _load_route_configs() -> list[dict]:
+    if X402_ROUTES:
+        return json.loads(X402_ROUTES)
+    if X402_ROUTES_FILE:
+        with open(X402_ROUTES_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    # 兼容单链配置
+    chain_id = int(os.getenv("CHAIN_ID", "11155111"))
+    return [{
+        "network": f"eip155:{chain_id}",
+        "chainId": chain_id,
+        "rpcUrl": os.getenv("RPC_URL_SEPOLIA"),
+        "asset": os.getenv("TOKEN_ADDRESS"),
+        "name": os.getenv("TOKEN_NAME", "USD Coin"),
+        "version": os.getenv("TOKEN_VERSION", "2"),
+    }]
+
+
+class SettlementRouter:
+    """
+    (network, asset) -> SettlementLane，启动时建好，请求里只做字典查找
+    """
+
+    def __init__(self, configs: list[dict]):
+        self.lanes: dict[tuple[str, str], SettlementLane] = {}
+        # chain_id -> relayer nonce 分配器，同链的通道共用
+        self.nonces: dict[int, RelayerNonce] = {}
+        for cfg in configs:
+            chain_id = int(cfg["chainId"])
+            lane = SettlementLane(
+                network=cfg["network"],
+                chain_id=chain_id,
+                rpc_url=cfg["rpcUrl"],
+                asset=cfg["asset"],
+                name=cfg.get("name", "USD Coin"),
+                version=cfg.get("version", "2"),
+                decimals=cfg.get("decimals"),
+                max_workers=int(cfg.get("maxWorkers", LANE_MAX_WORKERS)),
+                nonces=self.nonces.get(chain_id),
+            )
+            self.nonces.setdefault(chain_id, lane.nonces)
+            self.lanes[lane.key] = lane
+        # 只按 network 查时（payload 没带 asset），该链唯一的那个 token
+        self._by_network: dict[str, SettlementLane | None] = {}
+        for lane in self.lanes.values():
+            self._by_network[lane.network] = None if lane.network in self._by_network else lane
+
+        # 排空状态 + 在途结算（从通过校验开始算，到两笔都有结果为止）
+        self.draining = False
+        self._in_flight: set[Settlement] = set()
+        self._idle = threading.Condition()
+        self._record_lock = threading.Lock()
+        self.recorded_total = 0
+
+    def all(self) -> list[SettlementLane]:
+        return list(self.lanes.values())
+
+    def get(self, network: str | None, asset: str | None = None) -> SettlementLane | None:
+        if not network:
+            return None
+        if asset:
+            return self.lanes.get((network, asset.lower()))
+        return self._by_network.get(network)
+
+    def warm_up(self):
+        """
+        启动时把各通道的 decimals 查好，之后 402 报价不再访问 RPC；查不到的通道先跳过，用到时再查
+        """
+        for lane in self.all():
+            try:
+                lane.decimals
+            except Exception as e:
+                print(f"[router] {lane.network} {lane.asset} decimals lookup failed: {e}")
+
+    # ---- 排空 ----
+    def admit(self, lane: SettlementLane, auth_main: dict, auth_fee: dict) -> Settlement | None:
+        """
+        登记一笔新结算；排空中返回 None（调用方回 503）
+        """
+        with self._idle:
+            if self.draining:
+                return None
+            settlement = Settlement(lane, auth_main, auth_fee)
+            self._in_flight.add(settlement)
+            return settlement
+
+    def release(self, settlement: Settlement):
+        with self._idle:
+            self._in_flight.discard(settlement)
+            if not self._in_flight:
+                self._idle.notify_all()
+
+    def settle(self, settlement: Settlement) -> dict:
+        """
+        在通道线程里跑 relay_two_auth，结束后才从在途里去掉：
+        请求协程被取消也不影响排空时对它的等待
+        """
+        try:
+            return settlement.lane.relay_two_auth(settlement.auth_main, settlement.auth_fee, settlement)
+        except SettlementHandedOff:
+            # 两笔都广播了但回执没确认：带着交易哈希记下来
+            self._record([settlement])
+            raise
+        finally:
+            self.release(settlement)
+
+    def begin_drain(self):
+        with self._idle:
+            self.draining = True
+
+    def drain_status(self) -> dict:
+        with self._idle:
+            stages: dict[str, int] = {}
+            for settlement in self._in_flight:
+                stages[settlement.stage] = stages.get(settlement.stage, 0) + 1
+            return {"draining": self.draining, "in_flight": len(self._in_flight), "stages": stages}
+
+    def _record(self, settlements: list[Settlement]):
+        """
+        追加写进 PENDING_SETTLEMENTS_FILE（每笔只写一次）
+        """
+        with self._record_lock:
+            settlements = [s for s in settlements if not s.recorded]
+            if not settlements:
+                return
+            # 正在广播的先等它发完（拿到交易哈希）再记。RPC 卡住超过宽限期就按 *_sending 记下：
+            # 授权 nonce 只能用一次，补结算时重发也不会重复扣款
+            deadline = time.monotonic() + DRAIN_BROADCAST_GRACE_SECONDS
+            locked = []
+            for settlement in settlements:
+                if settlement.lock.acquire(timeout=max(0.0, deadline - time.monotonic())):
+                    locked.append(settlement)
+                settlement.recorded = True
+            try:
+                with open(PENDING_SETTLEMENTS_FILE, "a", encoding="utf-8") as f:
+                    for settlement in settlements:
+                        f.write(json.dumps(settlement.to_record()) + "\n")
+            finally:
+                for settlement in locked:
+                    settlement.lock.release()
+            self.recorded_total += len(settlements)
+        print(f"[router] {len(settlements)} settlement(s) recorded to {PENDING_SETTLEMENTS_FILE}")
+
+    def drain(self, timeout: float) -> int:
+        """
+        停止接收新结算，最多等 timeout 秒让在途的结算走完（两笔都广播、拿到回执）。
+        到期后各通道不再等回执，但还没广播的那一笔照样广播出去（最多再等 DRAIN_BROADCAST_GRACE_SECONDS），
+        回执没确认的带着交易哈希写进 PENDING_SETTLEMENTS_FILE。返回这次写入的记录数。
+        """
+        self.begin_drain()
+        recorded_before = self.recorded_total
+        with self._idle:
+            if self._idle.wait_for(lambda: not self._in_flight, timeout=timeout):
+                return self.recorded_total - recorded_before
+
+        print("[router] drain deadline hit, broadcasting remaining legs without waiting for receipts")
+        for lane in self.all():
+            lane._abandon.set()
+        with self._idle:
+            self._idle.wait_for(lambda: not self._in_flight, timeout=DRAIN_BROADCAST_GRACE_SECONDS)
+            leftover = list(self._in_flight)
+        # 宽限期内还卡在 pre-flight / 广播里的（比如 RPC 挂了），按当前进度记录，之后不再广播
+        self._record(leftover)
+        return self.recorded_total - recorded_before
+
+    def shutdown(self):
+        for lane in self.all():
+            lane.executor.shutdown(wait=True)
+
+
+router = SettlementRouter(_load_route_configs())
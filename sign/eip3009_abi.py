@@ -18,6 +18,17 @@ EIP3009_ABI = [
         ],
         "outputs": [],
     },
+    # 授权 nonce 是否已被使用（pre-flight 检查用）
+    {
+        "name": "authorizationState",
+        "type": "function",
+        "stateMutability": "view",
+        "inputs": [
+            {"name": "authorizer", "type": "address"},
+            {"name": "nonce",      "type": "bytes32"},
+        ],
+        "outputs": [{"name": "", "type": "bool"}],
+    },
     # 可选：如果你想在代码里读 decimals()
     {
         "name": "decimals",
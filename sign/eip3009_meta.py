@@ -1,16 +1,21 @@
 # eip3009_meta.py
 import os
+import threading
 import time
 import uuid
+from concurrent.futures import ProcessPoolExecutor
 from decimal import Decimal
 from pathlib import Path
 
 from dotenv import load_dotenv
 from web3 import Web3
+from eth_abi import encode as abi_encode
 from eth_account import Account
 from eth_account.messages import encode_typed_data
+from eth_utils import keccak
 
 from sign.eip3009_abi import EIP3009_ABI
+from rpc_provider import make_provider
 
 BASE_DIR = Path(__file__).resolve().parents[1]
 env_path = BASE_DIR / "properties.env"
@@ -26,7 +31,7 @@ CHAIN_ID = int(os.getenv("CHAIN_ID", "11155111"))
 USER_PRIVATE_KEY = os.getenv("USER_PRIVATE_KEY")        # A：用户
 RELAYER_PRIVATE_KEY = os.getenv("RELAYER_PRIVATE_KEY")  # Service：代播+收手续费
 
-w3 = Web3(Web3.HTTPProvider(RPC_URL))
+w3 = Web3(make_provider(RPC_URL))  # RPC_URL_SEPOLIA 可配多个节点（逗号分隔）
 user_account = Account.from_key(USER_PRIVATE_KEY)
 relayer_account = Account.from_key(RELAYER_PRIVATE_KEY)
 
@@ -135,56 +140,278 @@ def build_transfer_authorization(
         "s": Web3.to_hex(s),
     }
 
-def relay_with_authorization(auth: dict) -> str:
+# ==== 批量签名 ====
+# domain separator 和 type hash 对同一个 token 是常量，启动时算一次；
+# 每份授权只需要 hash 自己的 struct，再和 domain separator 拼出 EIP-712 digest 签名。
+TRANSFER_WITH_AUTHORIZATION_TYPEHASH = keccak(
+    text="TransferWithAuthorization(address from,address to,uint256 value,"
+         "uint256 validAfter,uint256 validBefore,bytes32 nonce)"
+)
+EIP712_DOMAIN_TYPEHASH = keccak(
+    text="EIP712Domain(string name,string version,uint256 chainId,address verifyingContract)"
+)
+DOMAIN_SEPARATOR = keccak(abi_encode(
+    ["bytes32", "bytes32", "bytes32", "uint256", "address"],
+    [
+        EIP712_DOMAIN_TYPEHASH,
+        keccak(text=TOKEN_NAME),
+        keccak(text=TOKEN_VERSION),
+        CHAIN_ID,
+        Web3.to_checksum_address(TOKEN_ADDRESS),
+    ],
+))
+
+# 超过这么多笔才用进程池（小批量进程间通信反而更慢）
+BULK_SIGN_PROCESS_THRESHOLD = int(os.getenv("BULK_SIGN_PROCESS_THRESHOLD", "200"))
+# 每个进程一次处理多少对
+BULK_SIGN_CHUNK_SIZE = int(os.getenv("BULK_SIGN_CHUNK_SIZE", "100"))
+BULK_SIGN_WORKERS = int(os.getenv("BULK_SIGN_WORKERS", str(os.cpu_count() or 1)))
+
+_sign_pool: ProcessPoolExecutor | None = None
+
+
+def sign_transfer_authorization(
+    from_addr: str,
+    to_addr: str,
+    value_atomic: int,
+    valid_after: int,
+    valid_before: int,
+    nonce: bytes,
+) -> dict:
+    """
+    签名内容和返回结构都与 build_transfer_authorization 相同，但直接用预先算好的 DOMAIN_SEPARATOR 拼 digest，
+    不再每次构造 domain / types 字典走 encode_typed_data。r / s 固定输出 32 字节 hex。
+    """
+    from_addr = Web3.to_checksum_address(from_addr)
+    to_addr = Web3.to_checksum_address(to_addr)
+
+    struct_hash = keccak(abi_encode(
+        ["bytes32", "address", "address", "uint256", "uint256", "uint256", "bytes32"],
+        [
+            TRANSFER_WITH_AUTHORIZATION_TYPEHASH,
+            from_addr,
+            to_addr,
+            int(value_atomic),
+            int(valid_after),
+            int(valid_before),
+            nonce,
+        ],
+    ))
+    digest = keccak(b"\x19\x01" + DOMAIN_SEPARATOR + struct_hash)
+    signed = user_account.unsafe_sign_hash(digest)
+
+    return {
+        "from": from_addr,
+        "to": to_addr,
+        "value": str(int(value_atomic)),
+        "validAfter": str(int(valid_after)),
+        "validBefore": str(int(valid_before)),
+        "nonce": Web3.to_hex(nonce),
+        "v": signed.v,
+        "r": Web3.to_hex(signed.r.to_bytes(32, "big")),
+        "s": Web3.to_hex(signed.s.to_bytes(32, "big")),
+    }
+
+
+def _sign_pairs_chunk(chunk: list, from_addr: str, to_service: str, fee_atomic: int, valid_before: int) -> list:
+    """
+    签一批 (to, amount_atomic)，每个收款人一对 auth_main / auth_fee。进程池的 worker 入口。
+    """
+    pairs = []
+    for to_addr, amount_atomic in chunk:
+        auth_main = sign_transfer_authorization(
+            from_addr, to_addr, amount_atomic, 0, valid_before,
+            random_nonce_bytes32().rjust(32, b"\x00"),
+        )
+        auth_fee = sign_transfer_authorization(
+            from_addr, to_service, fee_atomic, 0, valid_before,
+            random_nonce_bytes32().rjust(32, b"\x00"),
+        )
+        pairs.append({"to": auth_main["to"], "auth_main": auth_main, "auth_fee": auth_fee})
+    return pairs
+
+
+def _get_sign_pool() -> ProcessPoolExecutor:
+    global _sign_pool
+    if _sign_pool is None:
+        _sign_pool = ProcessPoolExecutor(max_workers=BULK_SIGN_WORKERS)
+    return _sign_pool
+
+
+def iter_bulk_authorizations(
+    items: list,
+    from_addr: str | None = None,
+    fee_atomic: int | None = None,
+    valid_for_seconds: int = 3600,
+):
+    """
+    批量签名：items = [(to_addr, amount_atomic), ...]，按原顺序逐块 yield 签好的
+    {"to", "auth_main", "auth_fee"}。数量超过 BULK_SIGN_PROCESS_THRESHOLD 时分块丢进进程池并行签名。
+    """
+    from_addr = from_addr or user_account.address
+    to_service = relayer_account.address
+    if fee_atomic is None:
+        fee_atomic = human_to_atomic("0.01")
+    valid_before = int(time.time()) + valid_for_seconds
+
+    chunks = [items[i:i + BULK_SIGN_CHUNK_SIZE] for i in range(0, len(items), BULK_SIGN_CHUNK_SIZE)]
+
+    if len(items) < BULK_SIGN_PROCESS_THRESHOLD:
+        for chunk in chunks:
+            yield from _sign_pairs_chunk(chunk, from_addr, to_service, fee_atomic, valid_before)
+        return
+
+    pool = _get_sign_pool()
+    futures = [
+        pool.submit(_sign_pairs_chunk, chunk, from_addr, to_service, fee_atomic, valid_before)
+        for chunk in chunks
+    ]
+    for future in futures:
+        yield from future.result()
+
+
+def build_bulk_authorizations(
+    items: list,
+    from_addr: str | None = None,
+    fee_atomic: int | None = None,
+    valid_for_seconds: int = 3600,
+) -> list:
+    """
+    iter_bulk_authorizations 的一次性返回版本
+    """
+    return list(iter_bulk_authorizations(items, from_addr, fee_atomic, valid_for_seconds))
+
+
+def authorization_args(auth: dict) -> list:
+    """
+    把授权 dict 转成 transferWithAuthorization 的参数列表（from, to, value, validAfter, validBefore, nonce, v, r, s）
+    """
+    return [
+        Web3.to_checksum_address(auth["from"]),
+        Web3.to_checksum_address(auth["to"]),
+        int(auth["value"]),
+        int(auth["validAfter"]),
+        int(auth["validBefore"]),
+        Web3.to_bytes(hexstr=auth["nonce"]),
+        int(auth["v"]),
+        Web3.to_bytes(hexstr=auth["r"]),
+        Web3.to_bytes(hexstr=auth["s"]),
+    ]
+
+
+# ==== relayer nonce ====
+# 多笔并发广播时不能每笔都直接用查到的 pending nonce（会拿到同一个值互相顶掉），进程内自己递增分配。
+# 同一把 relayer 私钥可能同时被别的进程使用（多个 uvicorn worker、gasless_api、和网关一起跑的 batch_relay），
+# 所以每次分配都和链上 pending nonce 取较大值；广播遇到 nonce 冲突就重新同步后重试。
+RELAYER_NONCE_RETRIES = int(os.getenv("RELAYER_NONCE_RETRIES", "3"))
+# 节点返回这些错误说明 nonce 被别人用了 / 本地计数不对，重新同步换一个 nonce 再发
+NONCE_ERROR_MARKERS = (
+    "nonce too low",
+    "nonce too high",
+    "replacement transaction underpriced",
+    "nonce has already been used",
+)
+
+
+def is_nonce_error(e: Exception) -> bool:
+    message = str(e).lower()
+    return any(marker in message for marker in NONCE_ERROR_MARKERS)
+
+
+class RelayerNonce:
+    """
+    relayer 在一条链上的 nonce 分配器
+    - allocate：max(本地计数, 链上 pending)，落后于别的进程时自动追上
+    - release：签名 / 广播失败、交易没发出去时把 nonce 还回来，避免留下空洞卡住后面的交易
+    - resync：遇到 nonce 冲突时丢掉本地状态
+    """
+
+    def __init__(self, chain_w3: Web3, address: str):
+        self.w3 = chain_w3
+        self.address = address
+        self._next: int | None = None
+        self._free: set[int] = set()
+        self._lock = threading.Lock()
+
+    def allocate(self) -> int:
+        with self._lock:
+            pending = self.w3.eth.get_transaction_count(self.address, "pending")
+            # 还回来的 nonce 优先用掉（已经被链上追过的丢弃）
+            self._free = {n for n in self._free if n >= pending}
+            if self._free:
+                nonce = min(self._free)
+                self._free.remove(nonce)
+                return nonce
+            if self._next is None or self._next < pending:
+                self._next = pending
+            nonce = self._next
+            self._next += 1
+            return nonce
+
+    def release(self, nonce: int):
+        with self._lock:
+            if self._next is not None and nonce == self._next - 1:
+                self._next -= 1
+            else:
+                self._free.add(nonce)
+
+    def resync(self):
+        with self._lock:
+            self._next = None
+            self._free.clear()
+
+
+def send_with_relayer_nonce(chain_w3: Web3, nonces: RelayerNonce, tx: dict):
+    """
+    分配 nonce → 签名 → 广播，返回 tx_hash；nonce 冲突时重新同步、换 nonce 重试（最多 RELAYER_NONCE_RETRIES 次），
+    其他错误把 nonce 还回去后原样抛出
+    """
+    for attempt in range(RELAYER_NONCE_RETRIES + 1):
+        nonce = nonces.allocate()
+        try:
+            signed = relayer_account.sign_transaction({**tx, "nonce": nonce})
+            return chain_w3.eth.send_raw_transaction(signed.raw_transaction)
+        except Exception as e:
+            if is_nonce_error(e) and attempt < RELAYER_NONCE_RETRIES:
+                print(f"Nonce {nonce} rejected ({e}), resyncing relayer nonce")
+                nonces.resync()
+                continue
+            if is_nonce_error(e):
+                nonces.resync()
+            else:
+                nonces.release(nonce)
+            raise
+
+
+def settlement_lane(network: str | None = None, asset: str | None = None):
+    """
+    结算统一走 settlement_router 的通道（同一套广播 / 回执 / relayer nonce）；
+    不指定 network 时用本模块配置的默认链 + token
+    """
+    # 延迟导入：settlement_router 依赖本模块
+    from settlement_router import router
+
+    if network is None:
+        network, asset = f"eip155:{CHAIN_ID}", asset or TOKEN_ADDRESS
+    lane = router.get(network, asset)
+    if lane is None:
+        raise RuntimeError(f"No settlement lane for network={network} asset={asset}")
+    return lane
+
+
+def relay_with_authorization(auth: dict, network: str | None = None, asset: str | None = None) -> str:
     """
     只负责：用 relayer 私钥调用 transferWithAuthorization。
     auth: 必须包含 from/to/value/validAfter/validBefore/nonce/v/r/s 字段
     返回 tx_hash(hex)
     """
-    from_addr = auth["from"]
-    to_addr = auth["to"]
-    value = int(auth["value"])
-    valid_after = int(auth["validAfter"])
-    valid_before = int(auth["validBefore"])
-    nonce = Web3.to_bytes(hexstr=auth["nonce"])
-    v = int(auth["v"])
-    r = Web3.to_bytes(hexstr=auth["r"])
-    s = Web3.to_bytes(hexstr=auth["s"])
-
-    tx = token.functions.transferWithAuthorization(
-        Web3.to_checksum_address(from_addr),
-        Web3.to_checksum_address(to_addr),
-        value,
-        valid_after,
-        valid_before,
-        nonce,
-        v, r, s,
-    ).build_transaction(
-        {
-            "from": relayer_account.address,
-            "nonce": w3.eth.get_transaction_count(relayer_account.address, "pending"),
-            "chainId": CHAIN_ID,
-            "gas": 200_000,
-            "maxFeePerGas": w3.to_wei("2", "gwei"),
-            "maxPriorityFeePerGas": w3.to_wei("1", "gwei"),
-        }
-    )
+    return settlement_lane(network, asset).relay_with_authorization(auth)
 
-    signed = relayer_account.sign_transaction(tx)
-    tx_hash = w3.eth.send_raw_transaction(signed.raw_transaction)
-    print("Sent meta-tx:", tx_hash.hex())
-    receipt = w3.eth.wait_for_transaction_receipt(tx_hash)
-    print("Status:", receipt.status)
-    if receipt.status != 1:
-        raise RuntimeError("Meta-tx failed")
-    return tx_hash.hex()
 
-def relay_two_auth(auth_main: dict, auth_fee: dict) -> dict:
+def relay_two_auth(auth_main: dict, auth_fee: dict, network: str | None = None, asset: str | None = None) -> dict:
     """
     播两笔 meta-tx：
     1) auth_main: A -> B（本金）
     2) auth_fee:  A -> Service（手续费）
     """
-    tx_main = relay_with_authorization(auth_main)
-    tx_fee = relay_with_authorization(auth_fee)
-    return {"tx_main": tx_main, "tx_fee": tx_fee}
+    return settlement_lane(network, asset).relay_two_auth(auth_main, auth_fee)
@@ -0,0 +1,144 @@
+# eip3009_preflight.py
+# 播交易之前的检查：一次 JSON-RPC batch 拿到余额、两个 nonce 的使用状态、两笔 transferWithAuthorization 的模拟结果，
+# 任何一项不通过就直接拒绝，避免“本金成功、手续费 revert”白白付两笔 gas。
+import os
+import threading
+import time
+
+from erc20_utils import ERC20_ABI
+from sign.eip3009_meta import w3, token, relayer_account, authorization_args
+
+# 热点付款人的余额缓存多久（秒）
+BALANCE_CACHE_TTL = float(os.getenv("BALANCE_CACHE_TTL", "5"))
+
+# (token(lower), from(lower)) -> (balance, 过期时间)
+_balance_cache: dict[tuple[str, str], tuple[int, float]] = {}
+_balance_lock = threading.Lock()
+
+
+class PreflightError(Exception):
+    """
+    pre-flight 不通过（余额不足 / nonce 已用 / 模拟 revert）
+    """
+
+
+def get_cached_balance(token_addr: str, addr: str) -> int | None:
+    with _balance_lock:
+        cached = _balance_cache.get((token_addr.lower(), addr.lower()))
+        if cached is None or cached[1] < time.monotonic():
+            return None
+        return cached[0]
+
+
+def cache_balance(token_addr: str, addr: str, balance: int):
+    with _balance_lock:
+        _balance_cache[(token_addr.lower(), addr.lower())] = (balance, time.monotonic() + BALANCE_CACHE_TTL)
+
+
+def invalidate_balance(addr: str, token_addr: str | None = None):
+    """
+    替这个地址结算过（不管成功与否）之后调用，余额已经变了。不传 token_addr 则清掉该地址所有 token 的缓存
+    """
+    with _balance_lock:
+        if token_addr is not None:
+            _balance_cache.pop((token_addr.lower(), addr.lower()), None)
+            return
+        for key in [k for k in _balance_cache if k[1] == addr.lower()]:
+            del _balance_cache[key]
+
+
+def _eth_call(req_id: str, to: str, data: str, from_addr: str | None = None) -> tuple:
+    call = {"to": to, "data": data}
+    if from_addr:
+        call["from"] = from_addr
+    return req_id, ("eth_call", [call, "latest"])
+
+
+def _rpc_batch(chain_w3, calls: list) -> dict:
+    """
+    通过 provider 发一个 JSON-RPC batch（多节点时走最快的健康节点），按名字返回 {name: 单条响应}
+    """
+    names = [name for name, _ in calls]
+    results = chain_w3.provider.make_batch_request([request for _, request in calls])
+    if not isinstance(results, list):
+        # 有的节点整个 batch 出错时返回单个对象
+        raise PreflightError(f"RPC batch failed: {results}")
+    # provider 已按请求 id 排好序，和请求顺序一一对应
+    return dict(zip(names, results))
+
+
+def _error_message(item: dict | None) -> str | None:
+    if item is None:
+        return "missing response"
+    if "error" in item:
+        error = item["error"]
+        return error.get("message", str(error)) if isinstance(error, dict) else str(error)
+    return None
+
+
+def _to_int(item: dict) -> int:
+    result = item.get("result") or "0x"
+    return int(result, 16) if result != "0x" else 0
+
+
+def preflight_two_auth(auth_main: dict, auth_fee: dict, chain_w3=None, chain_token=None) -> dict:
+    """
+    一次 batch 检查两份授权能否都成功：
+    - balanceOf(from) >= main.value + fee.value（余额有短缓存）
+    - authorizationState(from, nonce) 两个 nonce 都没被用过
+    - 以 relayer 身份 eth_call 模拟两笔 transferWithAuthorization 都不 revert
+    不通过抛 PreflightError，通过返回 {"balance", "required"}。
+    chain_w3 / chain_token 不传则用默认链（sign.eip3009_meta 里配置的那条）。
+    """
+    chain_w3 = chain_w3 or w3
+    chain_token = chain_token or token
+    erc20 = chain_w3.eth.contract(address=chain_token.address, abi=ERC20_ABI)
+    token_addr = chain_token.address
+
+    main_args = authorization_args(auth_main)
+    fee_args = authorization_args(auth_fee)
+    payer = main_args[0]
+    if fee_args[0] != payer:
+        raise PreflightError("auth_main.from != auth_fee.from")
+    if main_args[5] == fee_args[5]:
+        raise PreflightError("auth_main and auth_fee use the same nonce")
+
+    required = main_args[2] + fee_args[2]
+    balance = get_cached_balance(token_addr, payer)
+
+    calls = [
+        _eth_call("state_main", token_addr, chain_token.encode_abi("authorizationState", args=[payer, main_args[5]])),
+        _eth_call("state_fee", token_addr, chain_token.encode_abi("authorizationState", args=[payer, fee_args[5]])),
+        _eth_call("sim_main", token_addr, chain_token.encode_abi("transferWithAuthorization", args=main_args),
+                  relayer_account.address),
+        _eth_call("sim_fee", token_addr, chain_token.encode_abi("transferWithAuthorization", args=fee_args),
+                  relayer_account.address),
+    ]
+    if balance is None:
+        calls.append(_eth_call("balance", token_addr, erc20.encode_abi("balanceOf", args=[payer])))
+
+    results = _rpc_batch(chain_w3, calls)
+
+    if balance is None:
+        err = _error_message(results.get("balance"))
+        if err:
+            raise PreflightError(f"balanceOf failed: {err}")
+        balance = _to_int(results["balance"])
+        cache_balance(token_addr, payer, balance)
+
+    if balance < required:
+        raise PreflightError(f"insufficient balance: have {balance}, need {required} (amount + fee)")
+
+    for key, label in (("state_main", "auth_main"), ("state_fee", "auth_fee")):
+        err = _error_message(results.get(key))
+        if err:
+            raise PreflightError(f"authorizationState({label}) failed: {err}")
+        if _to_int(results[key]) != 0:
+            raise PreflightError(f"{label}.nonce already used")
+
+    for key, label in (("sim_main", "auth_main"), ("sim_fee", "auth_fee")):
+        err = _error_message(results.get(key))
+        if err:
+            raise PreflightError(f"{label} simulation reverted: {err}")
+
+    return {"balance": balance, "required": required}
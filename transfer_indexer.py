@@ -0,0 +1,298 @@
+# transfer_indexer.py
+# Transfer 事件索引：把配置的 token 里「服务地址 / 已知付款人」相关的 Transfer 日志落到本地 SQLite，
+# /history/{address} 直接查本地库，不碰 RPC。
+import os
+import sqlite3
+import threading
+
+from web3 import Web3
+
+from chain_utils import get_web3, get_token_address
+
+INDEXER_DB_PATH = os.getenv("INDEXER_DB_PATH", "transfers.db")
+# 从哪个区块开始回填（0 表示从当前区块往前 INDEXER_BACKFILL_BLOCKS 个区块开始）
+INDEXER_START_BLOCK = int(os.getenv("INDEXER_START_BLOCK", "0"))
+INDEXER_BACKFILL_BLOCKS = int(os.getenv("INDEXER_BACKFILL_BLOCKS", "50000"))
+# eth_getLogs 单次区块范围：出错就减半，成功就翻倍，不超过上限
+INDEXER_MAX_RANGE = int(os.getenv("INDEXER_MAX_RANGE", "5000"))
+INDEXER_MIN_RANGE = 1
+# 单次 eth_getLogs 的 topic 里最多放多少个地址（付款人越来越多时，一个超长 OR 列表会被节点拒绝）
+INDEXER_ADDRESSES_PER_QUERY = int(os.getenv("INDEXER_ADDRESSES_PER_QUERY", "100"))
+# 跟块轮询间隔
+INDEXER_POLL_SECONDS = float(os.getenv("INDEXER_POLL_SECONDS", "6"))
+# 发现重组时往回退多少个区块重新索引
+INDEXER_REORG_DEPTH = int(os.getenv("INDEXER_REORG_DEPTH", "64"))
+
+TRANSFER_TOPIC = Web3.to_hex(Web3.keccak(text="Transfer(address,address,uint256)"))
+
+
+def _address_topic(addr: str) -> str:
+    return "0x" + "0" * 24 + addr.lower()[2:]
+
+
+class TransferStore:
+    """
+    本地 SQLite：
+      transfers(tx_hash, log_index, block_number, block_hash, from_addr, to_addr, value)
+      watch(address, needs_backfill) 需要索引的地址；needs_backfill=1 表示它加入之前的历史还没回填
+      meta(key, value)              cursor（下一个要索引的区块）、tip_hash（已索引到的最后一个区块的 hash）
+    """
+
+    def __init__(self, path: str = INDEXER_DB_PATH):
+        self.path = path
+        self._local = threading.local()
+        with self._conn() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS transfers (
+                    tx_hash TEXT NOT NULL,
+                    log_index INTEGER NOT NULL,
+                    block_number INTEGER NOT NULL,
+                    block_hash TEXT NOT NULL,
+                    from_addr TEXT NOT NULL,
+                    to_addr TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    PRIMARY KEY (tx_hash, log_index)
+                );
+                CREATE INDEX IF NOT EXISTS transfers_from ON transfers(from_addr, block_number, log_index);
+                CREATE INDEX IF NOT EXISTS transfers_to ON transfers(to_addr, block_number, log_index);
+                CREATE INDEX IF NOT EXISTS transfers_block ON transfers(block_number);
+                CREATE TABLE IF NOT EXISTS watch (
+                    address TEXT PRIMARY KEY,
+                    needs_backfill INTEGER NOT NULL DEFAULT 1
+                );
+                CREATE TABLE IF NOT EXISTS meta (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL
+                );
+                """
+            )
+
+    def _conn(self) -> sqlite3.Connection:
+        # 每个线程一个连接（索引线程写，请求线程读）
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            self._local.conn = conn
+        return conn
+
+    # ---- meta ----
+    def get_meta(self, key: str) -> str | None:
+        row = self._conn().execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _set_meta(self, conn, key: str, value):
+        conn.execute(
+            "INSERT INTO meta(key, value) VALUES (?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+            (key, str(value)),
+        )
+
+    # ---- watch ----
+    def add_watch(self, address: str):
+        """
+        新地址加入索引（已经在了就什么都不做），它加入之前的历史由索引线程单独回填
+        """
+        with self._conn() as conn:
+            conn.execute("INSERT OR IGNORE INTO watch(address) VALUES (?)", (address.lower(),))
+
+    def watched(self) -> list[str]:
+        return [row[0] for row in self._conn().execute("SELECT address FROM watch")]
+
+    def pending_backfills(self) -> list[str]:
+        return [row[0] for row in self._conn().execute("SELECT address FROM watch WHERE needs_backfill = 1")]
+
+    def finish_backfill(self, address: str):
+        with self._conn() as conn:
+            conn.execute("UPDATE watch SET needs_backfill = 0 WHERE address = ?", (address.lower(),))
+
+    # ---- transfers ----
+    def insert_logs(self, rows: list, cursor: int | None = None, tip_hash: str | None = None):
+        """
+        写入一批日志；cursor / tip_hash 一起更新，保证同一个事务里提交
+        """
+        with self._conn() as conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO transfers"
+                "(tx_hash, log_index, block_number, block_hash, from_addr, to_addr, value) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+            if cursor is not None:
+                self._set_meta(conn, "cursor", cursor)
+            if tip_hash is not None:
+                self._set_meta(conn, "tip_hash", tip_hash)
+
+    def rewind(self, block_number: int):
+        """
+        重组：删掉 >= block_number 的记录，cursor 回退
+        """
+        with self._conn() as conn:
+            conn.execute("DELETE FROM transfers WHERE block_number >= ?", (block_number,))
+            self._set_meta(conn, "cursor", block_number)
+            conn.execute("DELETE FROM meta WHERE key = 'tip_hash'")
+
+    def history(self, address: str, limit: int = 50, before: tuple[int, int] | None = None) -> list[dict]:
+        """
+        按 (block_number, log_index) 倒序分页；before 是上一页最后一条的 (block_number, log_index)
+        """
+        address = address.lower()
+        params: list = [address, address]
+        where = "(from_addr = ? OR to_addr = ?)"
+        if before is not None:
+            where += " AND (block_number, log_index) < (?, ?)"
+            params += [before[0], before[1]]
+        params.append(limit)
+        rows = self._conn().execute(
+            "SELECT tx_hash, log_index, block_number, from_addr, to_addr, value FROM transfers "
+            f"WHERE {where} ORDER BY block_number DESC, log_index DESC LIMIT ?",
+            params,
+        ).fetchall()
+        return [
+            {
+                "txHash": r[0],
+                "logIndex": r[1],
+                "blockNumber": r[2],
+                "from": r[3],
+                "to": r[4],
+                "value": r[5],
+                "direction": "out" if r[3] == address else "in",
+            }
+            for r in rows
+        ]
+
+
+def _log_row(log) -> tuple:
+    topics = log["topics"]
+    return (
+        Web3.to_hex(log["transactionHash"]),
+        int(log["logIndex"]),
+        int(log["blockNumber"]),
+        Web3.to_hex(log["blockHash"]),
+        "0x" + bytes(topics[1])[-20:].hex(),
+        "0x" + bytes(topics[2])[-20:].hex(),
+        str(int.from_bytes(bytes(log["data"]), "big")),
+    )
+
+
+class TransferIndexer:
+    """
+    后台线程：
+    1) 回填：从起始区块到当前区块，按自适应区块范围 eth_getLogs
+    2) 跟块：每 INDEXER_POLL_SECONDS 拉一次新区块
+    3) 重组：每轮先对比已索引最后一个区块的 hash，不一致就回退 INDEXER_REORG_DEPTH 个区块重新索引
+    新加入的付款人地址单独回填它加入之前的历史。
+    """
+
+    def __init__(self, store: TransferStore, w3: Web3 | None = None, token_addr: str | None = None):
+        self.store = store
+        self.w3 = w3
+        self.token_addr = token_addr
+        self.range = INDEXER_MAX_RANGE
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    # ---- eth_getLogs（自适应区块范围） ----
+    def _get_logs(self, from_block: int, to_block: int, addresses: list[str]) -> list:
+        logs = []
+        # 地址按 INDEXER_ADDRESSES_PER_QUERY 分组；每组 from 命中 或 to 命中各查一次，入库时按 (tx_hash, log_index) 去重
+        for i in range(0, len(addresses), INDEXER_ADDRESSES_PER_QUERY):
+            topics = [_address_topic(a) for a in addresses[i:i + INDEXER_ADDRESSES_PER_QUERY]]
+            for topic_filter in ([TRANSFER_TOPIC, topics], [TRANSFER_TOPIC, None, topics]):
+                logs += self.w3.eth.get_logs({
+                    "fromBlock": from_block,
+                    "toBlock": to_block,
+                    "address": self.token_addr,
+                    "topics": topic_filter,
+                })
+        return logs
+
+    def _scan(self, start: int, end: int, addresses: list[str], on_chunk):
+        """
+        扫描 [start, end]，每扫完一段调用 on_chunk(rows, chunk_end)。
+        节点报错（范围太大 / 结果太多 / 超时）就把范围减半重试，成功后逐步放大。
+        """
+        block = start
+        while block <= end and not self._stop.is_set():
+            chunk_end = min(end, block + self.range - 1)
+            try:
+                logs = self._get_logs(block, chunk_end, addresses)
+            except Exception as e:
+                if self.range <= INDEXER_MIN_RANGE:
+                    raise
+                self.range = max(INDEXER_MIN_RANGE, self.range // 2)
+                print(f"[indexer] eth_getLogs {block}-{chunk_end} failed ({e}), range -> {self.range}")
+                continue
+            on_chunk([_log_row(log) for log in logs], chunk_end)
+            block = chunk_end + 1
+            self.range = min(INDEXER_MAX_RANGE, self.range * 2)
+
+    # ---- 重组检测 ----
+    def _check_reorg(self, cursor: int) -> int:
+        tip_hash = self.store.get_meta("tip_hash")
+        if tip_hash is None or cursor == 0:
+            return cursor
+        chain_hash = Web3.to_hex(self.w3.eth.get_block(cursor - 1)["hash"])
+        if chain_hash == tip_hash:
+            return cursor
+        rewind_to = max(0, cursor - INDEXER_REORG_DEPTH)
+        print(f"[indexer] reorg detected at block {cursor - 1}, rewinding to {rewind_to}")
+        self.store.rewind(rewind_to)
+        return rewind_to
+
+    # ---- 主循环 ----
+    def _initial_cursor(self, head: int) -> int:
+        cursor = self.store.get_meta("cursor")
+        if cursor is not None:
+            return int(cursor)
+        return INDEXER_START_BLOCK or max(0, head - INDEXER_BACKFILL_BLOCKS)
+
+    def run_once(self):
+        head = self.w3.eth.block_number
+        cursor = self._check_reorg(self._initial_cursor(head))
+
+        # 新地址：回填 [起始区块, cursor) 这段它还没被主循环覆盖的历史。
+        # cursor 只有本线程会推进，所以先回填、再取地址列表，中间新加入的地址下一轮再补，不会漏块。
+        start = INDEXER_START_BLOCK or max(0, head - INDEXER_BACKFILL_BLOCKS)
+        for address in self.store.pending_backfills():
+            if cursor > start:
+                self._scan(start, cursor - 1, [address], lambda rows, _: self.store.insert_logs(rows))
+            self.store.finish_backfill(address)
+
+        addresses = self.store.watched()
+        if not addresses or cursor > head:
+            return
+
+        def commit(rows, chunk_end):
+            tip_hash = Web3.to_hex(self.w3.eth.get_block(chunk_end)["hash"])
+            self.store.insert_logs(rows, cursor=chunk_end + 1, tip_hash=tip_hash)
+
+        self._scan(cursor, head, addresses, commit)
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                self.run_once()
+            except Exception as e:
+                print(f"[indexer] error: {e}")
+            self._stop.wait(INDEXER_POLL_SECONDS)
+
+    def start(self):
+        if self.w3 is None:
+            self.w3 = get_web3()
+        if self.token_addr is None:
+            self.token_addr = Web3.to_checksum_address(get_token_address())
+        self._thread = threading.Thread(target=self._loop, name="transfer-indexer", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=10)
+
+    def watch(self, address: str):
+        """
+        加入一个需要索引的地址（服务地址 / 付款人）
+        """
+        self.store.add_watch(address)